@@ -29,19 +29,12 @@ future
 
 TODO list:
 - Implement a save method for MLPNetwork
-- Find out how many times get_theta is running and consider doing
-  once only at network initialization
 - Check array caching is working in train()
 - Find a way to connect the inputs of one network to the
   outputs of another (ideally using a name-object reference
   so no copying is required).
-- Develop the Trainer class to manage all training
-- Consider adding 1.0s to training data inputs to speed up
-  training
-- Consider whether need to move to separate weights + biases
 - Consider making activation and gradient functions into named
   tuples instead of regular tuples - or not.
-- Allow for mini-batch updates in Trainer class training
 - Change training data subsets into a dictionary for easier
   retrieval
 - Remove MLP from class names (module name is sufficient)
@@ -51,10 +44,20 @@ TODO list:
 - Improve __repr__ function to show act func names only.
 """
 
+import os
+import json
 from functools import partial
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+import multiprocessing
+from multiprocessing import shared_memory
+import traceback
 import numpy as np
 from scipy.special import expit
-from scipy.optimize import minimize
+from scipy.linalg.blas import get_blas_funcs
+from scipy.optimize import minimize, OptimizeResult, line_search
 from builtins import input
 
 
@@ -84,7 +87,7 @@ np.seterr(all='warn')
 # module.
 sigmoid = expit
 
-def sigmoid_gradient(z, a=None):
+def sigmoid_gradient(z, a=None, out=None):
     """sigmoid_gradient(z)
 
     sigmoid_gradient returns the derivative of the sigmoid function
@@ -100,6 +103,9 @@ def sigmoid_gradient(z, a=None):
         this has already been calculated, it will speed up the
         computation.
 
+    out : ndarray
+        (optional) An array to write the result to.
+
     Returns
     -------
     out : ndarray
@@ -110,7 +116,10 @@ def sigmoid_gradient(z, a=None):
     if a is None:
         a = sigmoid(z)
 
-    return a*(1.0 - a)
+    out = np.subtract(1.0, a, out=out)
+    out *= a
+
+    return out
 
 
 # 2. ArcTan activation function and gradient
@@ -118,16 +127,20 @@ def sigmoid_gradient(z, a=None):
 # Use numpy vectorized version
 arctan = np.arctan
 
-def arctan_gradient(z, a=None):
+def arctan_gradient(z, a=None, out=None):
     """arctan_gradient(z) returns the derivative of the arctan
     activation function evaluated at z.
 
     Providing a value for a has no effect. The argument is only
-    there for consistency with other activation functions.
+    there for consistency with other activation functions.  If an
+    array is provided for out, the result is written to it.
     """
 
     # There is no faster way to compute this using a
-    return 1.0/(z**2 + 1.0)
+    out = np.multiply(z, z, out=out)
+    out += 1.0
+
+    return np.reciprocal(out, out=out)
 
 
 # 3. Hyperbolic tangent (tanh) activation function and gradient
@@ -135,60 +148,85 @@ def arctan_gradient(z, a=None):
 # Use numpy vectorized version
 tanh = np.tanh
 
-def tanh_gradient(z, a=None):
+def tanh_gradient(z, a=None, out=None):
     """tanh_gradient(z) returns the derivative of the tanh
     activation function evaluated at z.
 
     If a=tanh(z) is provided, then the computation will be
-    significantly faster.
+    significantly faster.  If an array is provided for out, the
+    result is written to it.
     """
 
     if a is None:
-        a = tanh(z)
+        a = tanh(z, out=out)
 
-    return 1.0 - a**2
+    out = np.multiply(a, a, out=out)
+
+    return np.subtract(1.0, out, out=out)
 
 
 # 4. Linear activation function and gradient
 
-def linear(z):
+def linear(z, out=None):
     """linear(z) is a linear activation function that
     returns z.
+
+    If an array is provided for out, the values of z are copied
+    into it.
     """
 
-    return z
+    if out is None:
+        return z
+    if out is not z:
+        out[:] = z
 
-def linear_gradient(z, a=None):
+    return out
+
+def linear_gradient(z, a=None, out=None):
     """linear_gradient(z) returns the derivative of the
     linear activation function which is 1.0.
 
     Providing a value for a has no effect. The argument is only
-    there for consistency with other activation functions.
+    there for consistency with other activation functions.  If an
+    array is provided for out, it is filled with ones.
     """
 
-    return np.ones(z.shape)
+    if out is None:
+        return np.ones_like(z)
+
+    out.fill(1.0)
+
+    return out
 
 
 # 5. Rectified Linear Unit (ReLU) activation function
 
-def relu(z):
+def relu(z, out=None):
     """relu(z) is the activation function known as ReLU
     (rectified linear unit).
+
+    If an array is provided for out, the result is written to it
+    (out may be z).
     """
 
-    return z*(z > 0)
-    # return np.maximum(0, z)  # Alternative - slightly slower
+    # np.maximum creates no temporary arrays (z*(z > 0) creates
+    # two)
+    return np.maximum(z, 0.0, out=out)
 
 
-def relu_gradient(z, a=None):
+def relu_gradient(z, a=None, out=None):
     """relu_gradient(z) returns the gradient of the ReLU
     (Rectified Linear Unit) activation function at z.
 
     Providing a value for a has no effect. The argument is only
-    there for consistency with other activation functions.
+    there for consistency with other activation functions.  If an
+    array is provided for out, the result is written to it.
     """
 
-    return (z > 0).astype(float)
+    if out is None:
+        return (z > 0).astype(z.dtype)
+
+    return np.greater(z, 0.0, out=out)
 
 # 6. Softmax
 
@@ -225,7 +263,11 @@ def softmax_gradient(z, y, a):
         return -a*z
 
 # This dictionary is used to reference activation functions
-# and their derivatives by name
+# and their derivatives by name.  All the activation functions
+# and derivative functions accept an optional out argument (numpy
+# ufuncs such as expit, np.arctan and np.tanh do so already) so
+# that the results can be written to an existing array without
+# creating temporary arrays (see activation_benchmark).
 
 activation_functions = {
     "sigmoid": (sigmoid, sigmoid_gradient),
@@ -235,13 +277,92 @@ activation_functions = {
     "relu": (relu, relu_gradient)
 }
 
+# Fused versions of the activation functions used during training.
+# Each one calculates the activations a and the derivatives d of
+# the activation function for the inputs z at the same time and
+# writes them into the arrays provided (no new arrays are created).
+# The derivatives are stored during the feed-forward pass so that
+# back-propagation does not need to calculate them again.
+
+def sigmoid_fused(z, a, d):
+    """Writes sigmoid(z) to a and its derivative to d."""
+
+    sigmoid(z, out=a)
+    np.subtract(1.0, a, out=d)
+    d *= a
+
+def arctan_fused(z, a, d):
+    """Writes arctan(z) to a and its derivative to d."""
+
+    arctan(z, out=a)
+    np.multiply(z, z, out=d)
+    d += 1.0
+    np.reciprocal(d, out=d)
+
+def tanh_fused(z, a, d):
+    """Writes tanh(z) to a and its derivative to d."""
+
+    tanh(z, out=a)
+    np.multiply(a, a, out=d)
+    np.subtract(1.0, d, out=d)
+
+def relu_fused(z, a, d):
+    """Writes relu(z) to a and its derivative to d."""
+
+    np.greater(z, 0.0, out=d)
+    np.maximum(z, 0.0, out=a)
+
+# This dictionary is used to look up the fused function of an
+# activation function.  The derivative of the linear activation
+# function is 1.0 so no derivatives are stored for linear layers
+# and the multiplication by the derivatives is skipped.  Activation
+# functions not in this dictionary (e.g. user-defined functions)
+# are calculated with the regular functions.
+
+fused_activation_functions = {
+    sigmoid: sigmoid_fused,
+    arctan: arctan_fused,
+    tanh: tanh_fused,
+    relu: relu_fused
+}
+
+# Activation functions whose derivatives can be calculated from
+# the activations (a) alone.  In lean arrays (see
+# initialize_arrays) the derivatives of these functions are not
+# stored during the feed-forward pass.  They are calculated from
+# the activations during back-propagation instead.
+
+derivatives_from_activations = {sigmoid, tanh}
+
 # Set the default activation function to use if user does
 # not specify one.
 
 default_act_func = activation_functions["sigmoid"]
 default_cost_function = 'log'
 
-# Some processor timings
+# Default data type of network weights, training data and all
+# arrays used in computations.  np.float32 halves the memory needed
+# and speeds up the matrix computations but is less accurate.
+default_dtype = np.float64
+
+# Default number of rows processed at a time when working through
+# large (e.g. memory-mapped) arrays in chunks
+default_chunk_size = 10000
+
+# Default maximum size (in bytes) of the arrays used to calculate
+# the cost function and gradients on a whole training data set.
+# Larger data sets are processed in chunks of rows (see
+# initialize_training_arrays).
+default_memory_budget = 256*2**20
+
+# Maximum number of weights arrays for which
+# MLPNetwork.get_layer_params keeps the lists of layer weight and
+# bias arrays (see get_layer_params)
+theta_cache_size = 4
+
+# Some processor timings (see activation_benchmark to compare
+# these with the versions of the functions that write to an
+# existing array)
 
 # %timeit sigmoid(z)
 # The slowest run took 24.89 times longer than the fastest.
@@ -304,6 +425,8 @@ class MLPLayer(object):
                    all neurons in this layer.  If not specified,
                    act_func=default_act_func which should be defined
                    in this module.
+    dtype       -- numpy data type of the outputs array.  If not
+                   specified, default_dtype is used.
 
     Attributes:
     n_nodes     -- the number of nodes in the layer (excluding the
@@ -322,11 +445,16 @@ class MLPLayer(object):
                    zero initially and outputs[0] is a fixed value
                    always set to 1.0.
     weights     -- Set to None initially, weights is assigned a
-                   2-dimensional slice of the network's weights array
-                   during the initialisation of a multi-layer
-                   network which contains the weights associated with
-                   the nodes in this layer (unless this is the input
-                   layer, in which case, weights remains None).
+                   2-dimensional view (n_nodes, number of inputs) of
+                   the network's weights array during the
+                   initialisation of a multi-layer network which
+                   contains the weights applied to the outputs of
+                   input_layer (unless this is the input layer, in
+                   which case, weights remains None).
+    bias        -- Set to None initially, bias is assigned a
+                   one-dimensional view (n_nodes, ) of the network's
+                   weights array containing the bias terms of the
+                   nodes in this layer.
 
     Methods:
     calculate_outputs -- calculates the output values from this layer
@@ -335,22 +463,27 @@ class MLPLayer(object):
     """
 
     def __init__(self, n_nodes, input_layer=None,
-                 act_func=default_act_func):
+                 act_func=default_act_func, dtype=None):
+
+        if dtype is None:
+            dtype = default_dtype
 
         self.n_nodes = n_nodes
         self.n_outputs = n_nodes + 1
-        self.outputs = np.zeros(self.n_outputs, dtype=np.float)
+        self.outputs = np.zeros(self.n_outputs, dtype=dtype)
         self.outputs[0] = 1.0
         self.input_layer = input_layer
         self.act_func = act_func
         self.weights = None
+        self.bias = None
 
     def calculate_outputs(self):
         """Calculate the outputs of each neuron in the layer."""
 
         if self.input_layer:
             self.outputs[1:] = self.act_func[0](
-                np.dot(self.weights, self.input_layer.outputs)
+                np.dot(self.weights, self.input_layer.outputs[1:]) +
+                self.bias
                 )
         else:
             raise MLPError("Layer has no inputs.  Note: Cannot "
@@ -387,9 +520,14 @@ class MLPNetwork(object):
                      negative log-likelihood function, desired outputs
                      must be 0.0 or 1.0 and a sigmoid acrtivation function
                      must be used in the output layer.
+    dtype         -- numpy data type of the weights and of the arrays
+                     used to make predictions and train the network
+                     (e.g. np.float32 or np.float64).  If not specified,
+                     default_dtype is used.
 
     Attributes:
     name       -- a string to label the network.
+    dtype      -- numpy data type of the weights.
     dimensions -- a list of integers to describe the number of nodes
                   in each layer.  Layer 0 is the input layer.
     n_layers   -- number of layers (including the input layer)
@@ -401,7 +539,16 @@ class MLPNetwork(object):
                   the input layer.
     n_weights  -- number of variable weights.
     weights    -- one-dimensional numpy array of all network weights
-                  (weights are set to zero initially).
+                  (weights are set to zero initially).  The weights
+                  of each layer are stored in turn: first the
+                  2-dimensional array of weights applied to the
+                  layer inputs (row by row) and then the layer's
+                  bias terms (see weight_views).
+    theta      -- list of the 2-dimensional arrays of the weights of
+                  each layer (views of weights).  First item is None.
+    bias       -- list of the one-dimensional arrays of the bias
+                  terms of each layer (views of weights).  First item
+                  is None.
     gradients  -- one-dimensional numpy array of weight 'gradients'.
                   These are used during learning.
     inputs     -- one-dimensional numpy array of network input values
@@ -419,6 +566,13 @@ class MLPNetwork(object):
                   below). (Default: 0.0).
     sigma      -- Coefficient used during training to normalize input
                   data.  See 'mu' above. (Default: 1.0).
+    theta_cache  -- dictionary of the lists of arrays created by
+                  get_layer_params from weights arrays provided to
+                  it.
+    theta_calls  -- number of times get_layer_params has been called.
+    theta_builds -- number of times get_layer_params had to create
+                  new lists of arrays (i.e. calls that were not found
+                  in theta_cache).
 
     Methods:
     cost_function      -- calculates the cost function for the network
@@ -429,6 +583,8 @@ class MLPNetwork(object):
                           outputs array will be computed as a result.
     get_theta          -- returns the current weights of each layer as
                           arrays.
+    get_layer_params   -- returns the weights and bias terms of each
+                          layer as separate arrays.
     initialize_weights -- initialize the network weights with random
                           numbers.
     set_inputs         -- this is a safe method to set the values of the
@@ -447,9 +603,13 @@ class MLPNetwork(object):
 
     def __init__(self, ndim, name=None, act_funcs=None,
                  cost_function=default_cost_function, mu=0.0,
-                 sigma=1.0):
+                 sigma=1.0, dtype=None):
+
+        if dtype is None:
+            dtype = default_dtype
 
         self.name = name
+        self.dtype = np.dtype(dtype)
         self.dimensions = ndim
         self.n_layers = len(ndim)
         self.n_inputs = ndim[0]
@@ -497,35 +657,24 @@ class MLPNetwork(object):
             new_layer = MLPLayer(
                 d,
                 input_layer=previous,
-                act_func=act_func
+                act_func=act_func,
+                dtype=self.dtype
             )
             self.layers.append(new_layer)
             if previous:
-                self.n_weights += (new_layer.n_outputs - 1)* \
-                                     previous.n_outputs
+                # Weights of each input and a bias term per node
+                self.n_weights += new_layer.n_nodes*(previous.n_nodes + 1)
             previous = new_layer
 
         # Now initialise weights
-        self.weights = np.zeros(self.n_weights, dtype=np.float)
+        self.weights = np.zeros(self.n_weights, dtype=self.dtype)
         self.gradients = None
 
-        first = 0
-        previous = self.layers[0]
+        # Views of the weights and bias terms of each layer
+        self.theta, self.bias = weight_views(self, self.weights)
         for j, layer in enumerate(self.layers[1:], start=1):
-            last = first + previous.n_outputs*(layer.n_outputs - 1)
-            if last > self.n_weights:
-                raise MLPError("Error initialising indices of weights arrays.")
-            layer.weights = self.weights[first:last]
-            try:
-                layer.weights.shape = (
-                    layer.n_outputs - 1,
-                    previous.n_outputs
-                )
-            except:
-                raise MLPError("Error re-shaping the array of weights "
-                               " for layer" + str(j))
-            previous = layer
-            first = last
+            layer.weights = self.theta[j]
+            layer.bias = self.bias[j]
 
         # Note that the first output from each layer is always set
         # to 1.0 so the network inputs and outputs arrays must exclude
@@ -534,6 +683,11 @@ class MLPNetwork(object):
         self.inputs = self.layers[0].outputs[1:]
         self.outputs = self.layers[self.n_layers - 1].outputs[1:]
 
+        # Lists of arrays created by get_layer_params
+        self.theta_cache = {}
+        self.theta_calls = 0
+        self.theta_builds = 0
+
     def initialize_weights(self, epsilon=0.01, method='xavier'):
         """Set the network's weights to random values. Currently,
         two methods are implemented:
@@ -556,7 +710,8 @@ class MLPNetwork(object):
                   the gradient of the activation function is 1 at x=0.
                   It uses a zero-mean Gaussian distribution but the
                   variance is set to np.sqrt(1/n[l-1]) where n[l-1] is
-                  the number of nodes in the previous (input) layer.
+                  the number of inputs to the layer (the number of
+                  nodes in the previous layer plus the bias term).
 
                   method='he'. This is the method recommended by He
                   et al. (2015) which is intended for use with the
@@ -572,8 +727,9 @@ class MLPNetwork(object):
             for l in range(1, self.n_layers):
                 layer = self.layers[l]
                 shape = layer.weights.shape
-                epsilon = np.sqrt(n/shape[1])
+                epsilon = np.sqrt(n/(shape[1] + 1))
                 layer.weights[:] = np.random.standard_normal(shape)*epsilon
+                layer.bias[:] = np.random.standard_normal(shape[0])*epsilon
         else:
             raise ValueError("Invalid value for keyword argument 'method'")
 
@@ -617,7 +773,8 @@ class MLPNetwork(object):
 
     def get_theta(self, weights=None):
         """Returns the weights of each layer as a list of
-        2-dimensional arrays.  Note: these are not copies of the
+        2-dimensional arrays (the bias terms are not included, see
+        get_layer_params).  Note: these are not copies of the
         weights so assigning new values is possible.
 
         If a one-dimensional array of all network weights is
@@ -625,51 +782,65 @@ class MLPNetwork(object):
         instead (not from the current weights in the network).
         """
 
-        theta = list()
+        return self.get_layer_params(weights=weights)[0]
 
-        if weights is None:
+    def get_layer_params(self, weights=None):
+        """Returns a tuple (theta, bias) of two lists containing
+        the 2-dimensional array of weights applied to the inputs of
+        each layer and the one-dimensional array of bias terms of
+        each layer.  The first items are None because there are no
+        weights in the input layer.  Note: these are views of the
+        weights, not copies, so assigning new values is possible.
 
-            # Return the weight values from the network as a list of
-            # arrays
-            for layer in self.layers:
-                theta.append(layer.weights)
+        If a one-dimensional array of all network weights is
+        provided, the lists of arrays are created from this array
+        instead (not from the current weights in the network).
 
-        else:
+        The lists created for each weights array are kept in
+        theta_cache (for up to theta_cache_size arrays) and
+        returned again if get_layer_params is called with the same
+        array object.  Therefore, when calling it repeatedly (for
+        example in a cost function called by a solver) it is faster
+        to copy new weight values into the same array each time
+        rather than providing a new array.
+        """
 
-            if weights.shape != (self.n_weights, ):
-                raise ValueError(
-                    "Error: weights array provided was not the "
-                    "correct shape. Should be " + (self.n_weights, )
-                )
+        self.theta_calls += 1
 
-            # Create a list of numpy arrays from the 1-dimensional
-            # array of weights provided.  First item is empty because
-            # there are no weights in input layer
-            theta.append(None)
+        if weights is None:
 
-            # Go through each layer and roll up weight values
-            # into arrays and then add to the list
-            first = 0
-            for j, layer in enumerate(self.layers[1:], start=1):
-                last = first + layer.weights.size
-                if last > self.n_weights:
-                    raise MLPError(
-                        "Error: too many weights found in network."
-                    )
-                theta.append(weights[first:last])
-
-                try:
-                    theta[-1].shape = layer.weights.shape
-                except:
-                    raise MLPError(
-                        "Error re-shaping the array of weights "
-                        "from layer " + str(j)
-                    )
-                first = last
+            # Return the weight values from the network as lists of
+            # arrays
+            return self.theta, self.bias
+
+        # Look for lists already created from this array.  The
+        # array itself is stored with the lists so that the id
+        # cannot be re-used by another array while it is in the
+        # cache.
+        key = (id(weights), weights.shape)
+        cached = self.theta_cache.get(key)
+        if cached is not None and cached[0] is weights:
+            return cached[1]
+
+        self.theta_builds += 1
+
+        if weights.shape != (self.n_weights, ):
+            raise ValueError(
+                "Error: weights array provided was not the "
+                "correct shape. Should be " + str((self.n_weights, ))
+            )
 
-        return theta
+        params = weight_views(self, weights)
 
-    def predict(self, inputs, weights=None):
+        if len(self.theta_cache) >= theta_cache_size:
+            # Remove the oldest item
+            del self.theta_cache[next(iter(self.theta_cache))]
+        self.theta_cache[key] = (weights, params)
+
+        return params
+
+    def predict(self, inputs, weights=None, cache=None, copy=True,
+                chunk_size=None):
         """produce predictions using the neural network with its
         current weights or with a new set of weights provided.
 
@@ -681,6 +852,23 @@ class MLPNetwork(object):
         inputs  -- 2-dimensional array (m, n_in) of m sets of n input
                    values.
         weights -- (optional) one-dimensional array of weight values.
+        cache   -- (optional) a set of arrays for m inputs created by
+                   initialize_predict_arrays.  If provided, all the
+                   intermediate results are written to these arrays
+                   so that repeated calls do not allocate any new
+                   arrays (except for user-defined activation
+                   functions that are not in the
+                   activation_functions dictionary).
+        copy    -- If cache is provided and copy is False, the
+                   array returned is the output array in the cache
+                   (not a copy) which will be over-written by the
+                   next call.  Default is True.
+        chunk_size -- (optional) if provided, the inputs are
+                   processed chunk_size rows at a time using one set
+                   of arrays for chunk_size inputs.  Use this to make
+                   predictions for large arrays of inputs (e.g.
+                   memory-mapped arrays) without creating temporary
+                   arrays as large as the inputs.
         """
 
         # convert to 2-dimensional array
@@ -688,27 +876,85 @@ class MLPNetwork(object):
         if len(inputs.shape) == 1:
             inputs.shape = (1, inputs.shape[0])
 
-        # Useful values
-        m = inputs.shape[0]
+        if chunk_size is not None and inputs.shape[0] > chunk_size:
+            return self.predict_chunks(inputs, chunk_size,
+                                       weights=weights)
+
+        inputs = np.asarray(inputs, dtype=self.dtype)
+
+        theta, bias = self.get_layer_params(weights=weights)
+
+        if cache is not None:
+            A = cache['A']
+
+            if inputs.shape != A[0].shape:
+                raise ValueError(
+                    "Shape of inputs %s does not match the arrays "
+                    "provided in cache %s." % (inputs.shape, A[0].shape)
+                )
+
+            # Normalize the inputs
+            np.subtract(inputs, self.mu, out=A[0])
+            np.divide(A[0], self.sigma, out=A[0])
+
+            # Calculate the outputs of each layer in place
+            for j, layer in enumerate(self.layers[1:], start=1):
 
-        theta = self.get_theta(weights=weights)
+                np.dot(A[j - 1], theta[j].T, out=A[j])
+                A[j] += bias[j]
+                activate(layer, A[j], A[j])
+
+            return A[-1].copy() if copy else A[-1]
 
         # Normalize the inputs
         outputs = (inputs - self.mu)/self.sigma
 
         # Calculate the outputs of each layer based on the inputs
-        # of the layer below, remembering to add a column of ones
-        # to represent the bias terms
-        # TODO: Is there a way to avoid the concatenate here?
+        # of the layer below.  The bias terms are added separately
+        # (broadcast over all rows) so there is no need to add a
+        # column of ones to the inputs of each layer.
         for j, layer in enumerate(self.layers[1:], start=1):
 
-            outputs = layer.act_func[0](
-                np.dot(
-                    np.concatenate(
-                        (np.ones((m, 1), dtype=np.float), outputs),
-                        axis=1
-                    ),
-                    theta[j].T)
+            z = np.dot(outputs, theta[j].T)
+            z += bias[j]
+            activate(layer, z, z)
+            outputs = z
+
+        return outputs
+
+    def predict_chunks(self, inputs, chunk_size=None, weights=None):
+        """Produce predictions for a large array of inputs by
+        processing chunk_size rows at a time.  Only the array of
+        predictions returned and one set of arrays for chunk_size
+        inputs (see initialize_predict_arrays) are created.
+
+        Arguments:
+        inputs     -- 2-dimensional array (m, n_in) of m sets of n
+                      input values.  This may be a memory-mapped
+                      array (np.memmap).
+        chunk_size -- number of rows to process at a time.  Default
+                      is default_chunk_size.
+        weights    -- (optional) one-dimensional array of weight
+                      values.
+        """
+
+        if chunk_size is None:
+            chunk_size = default_chunk_size
+
+        m = inputs.shape[0]
+        chunk_size = min(chunk_size, m)
+        outputs = np.empty((m, self.n_outputs), dtype=self.dtype)
+        cache = initialize_predict_arrays(self, chunk_size)
+
+        for start in range(0, m, chunk_size):
+            finish = min(start + chunk_size, m)
+            if finish - start < chunk_size:
+                cache = {'A': [a[:finish - start] for a in cache['A']]}
+            outputs[start:finish] = self.predict(
+                inputs[start:finish],
+                weights=weights,
+                cache=cache,
+                copy=False
             )
 
         return outputs
@@ -786,12 +1032,42 @@ class MLPNetwork(object):
         )
 
     def check_gradients(self, training_data, weights=None, lambda_param=0.0,
-                        messages=True):
+                        messages=True, method='full', n_samples=10,
+                        seed=None):
         """check_gradients uses a numerical approximation to
         check the gradients calculated by the backpropagation
         algorithm.  It outputs the analytically and the
         numerically calculated gradients so you can compare
-        them.
+        them.  Returns the relative difference between the two.
+
+        The calculations are always done with np.float64 arrays
+        (whatever the dtype of the network) because the numerical
+        approximation is not accurate enough with lower precision.
+
+        Keyword arguments:
+        method    -- Method used to check the gradients:
+
+                     method='full'. The derivative with respect to
+                     every weight is estimated numerically.  This
+                     needs two evaluations of the cost function per
+                     weight so it is slow for large networks.
+
+                     method='sample'. Only the derivatives with
+                     respect to n_samples randomly-chosen weights in
+                     each layer are estimated.
+
+                     method='spsa'. The derivatives of the cost
+                     function in n_samples random directions (in
+                     which every weight is changed) are estimated and
+                     compared with the projections of the gradients
+                     onto the same directions.  This only needs
+                     2*n_samples evaluations of the cost function
+                     whatever the size of the network.
+        n_samples -- Number of weights per layer (method='sample') or
+                     number of directions (method='spsa').  Default
+                     is 10.
+        seed      -- (optional) seed for the random number generator
+                     used to choose the weights or directions.
         """
 
         if messages:
@@ -801,10 +1077,12 @@ class MLPNetwork(object):
         # current weights.
         if weights is None:
             weights = self.weights
+        weights = np.asarray(weights, dtype=np.float64)
 
         m = training_data.inputs.shape[0]
 
-        arrays = initialize_arrays(self, m)
+        arrays = initialize_arrays(self, m, dtype=np.float64,
+                                   training_data=training_data)
 
         # Define a cost function
         def cost_func(p):
@@ -828,10 +1106,60 @@ class MLPNetwork(object):
         # cost_func = lambda p: test_model.cost_function(p, input_layer_size,
         #                  hidden_layer_size, num_labels, X, y, lambda_param)
 
-        # cost_func returns a tuple (cost, grad)
+        # cost_func returns a tuple (cost, grad).  Note: grad is
+        # an array in the cache which is over-written by each
+        # evaluation so it is copied.
         cost, grad = cost_func(weights)
+        grad = grad.copy()
+
+        # The numerical estimates only need the cost
+        def cost_only(p):
+            return self.cost_function(
+                self,
+                training_data,
+                weights=p,
+                lambda_param=lambda_param,
+                jac=False,
+                cache=arrays
+            )
+
+        rng = np.random.RandomState(seed)
+
+        if method == 'full':
+            numgrad = compute_derivative_numerically(cost_only, weights)
 
-        numgrad = compute_derivative_numerically(cost_func, weights)
+        elif method == 'sample':
+
+            # Choose up to n_samples weights (including the bias
+            # terms) from each layer
+            indices = []
+            first = 0
+            for layer in self.layers[1:]:
+                size = layer.weights.size + layer.bias.size
+                choice = rng.choice(size, min(n_samples, size),
+                                    replace=False)
+                indices.append(first + np.sort(choice))
+                first += size
+            indices = np.concatenate(indices)
+
+            numgrad = compute_derivative_numerically(cost_only, weights,
+                                                     indices=indices)
+            grad = grad[indices]
+
+        elif method == 'spsa':
+
+            # Random directions with elements +1 or -1 scaled to
+            # unit length
+            directions = rng.choice((-1.0, 1.0),
+                                    size=(n_samples, self.n_weights))
+            directions /= np.sqrt(self.n_weights)
+
+            numgrad = compute_directional_derivatives(cost_only, weights,
+                                                      directions)
+            grad = np.dot(directions, grad)
+
+        else:
+            raise ValueError("Invalid value for keyword argument 'method'")
 
         # Visually examine the two gradient computations.  The two
         # columns you get should be very similar.
@@ -859,8 +1187,14 @@ class MLPNetwork(object):
                   "than 1e-7).\n")
             print("Relative Difference: %g\n" % diff)
 
-            biggest = np.argmax(diffs)
-            print("Parameter with greatest difference: %s\n" % biggest)
+            biggest = np.argmax(np.abs(diffs))
+            if method == 'spsa':
+                print("Direction with greatest difference: %s\n" % biggest)
+            elif method == 'sample':
+                print("Parameter with greatest difference: %s\n" %
+                      indices[biggest])
+            else:
+                print("Parameter with greatest difference: %s\n" % biggest)
             print(numgrad[biggest], grad[biggest])
 
         return diff
@@ -892,6 +1226,16 @@ class MLPTrainingData(object):
                use data and ndim.
     scaling -- If True, then the input data is normalized. Default
                is False.
+    dtype   -- numpy data type to store the data.  If not specified,
+               default_dtype is used.  Use the same data type as the
+               network to avoid conversions during training.
+    check_nan -- If True (default), the data is checked for NaN
+               values.  The check is done in chunks of rows so no
+               temporary arrays as large as the data are created.
+
+    To use a data set too large to fit in memory, save it to a
+    .npy file (see save) and use MLPTrainingData.from_file to open
+    it as a memory-mapped array.
 
     Attributes:
     n_in      -- (int) number of values in input data
@@ -903,22 +1247,31 @@ class MLPTrainingData(object):
                  of data, then data will be set to None.
     inputs    -- (ndarray) array of input data
     outputs   -- (ndarray) array of output data
+    mu, sigma -- Means and standard deviations used to normalize
+                 the input data if scaling was True (otherwise 0.0
+                 and 1.0).
     n_subsets -- (int) number of subsets of data.  This attribute
                  will only exist if the method split was called.
     subsets   -- (list) list of data subsets (each subset will be
-                 an ndarray).  This attribute will only exist if the
-                 method split() was called.
+                 an MLPTrainingSubset).  This attribute will only
+                 exist if the method split() was called.
+    dtype     -- numpy data type of the data.
     """
 
     def __init__(self, data=None, ndim=None, name=None,
-                 inputs=None, outputs=None, scaling=False):
+                 inputs=None, outputs=None, scaling=False, dtype=None,
+                 check_nan=True):
+
+        if dtype is None:
+            dtype = default_dtype
 
         self.name = name
+        self.dtype = np.dtype(dtype)
 
         if data is not None:
             self.n_in = ndim[0]
             self.n_out = ndim[-1]
-            self.data = np.asarray(data)
+            self.data = np.asarray(data, dtype=dtype)
 
             if len(self.data.shape) != 2:
                 raise ValueError("Training data must be a 2-dimensional "
@@ -930,7 +1283,7 @@ class MLPTrainingData(object):
                     "of inputs and outputs specified)."
                 )
 
-            if np.isnan(self.data).sum(axis=None) > 0:
+            if check_nan and contains_nan(self.data):
                 raise ValueError(
                     "'Not a number' (NaN) values found in training "
                     "data set provided."
@@ -942,16 +1295,16 @@ class MLPTrainingData(object):
         else:
             # TODO: This code can be tidied up:
             self.data = None
-            self.inputs = np.asarray(inputs, dtype=np.float)
-            self.outputs = np.asarray(outputs, dtype=np.float)
+            self.inputs = np.asarray(inputs, dtype=dtype)
+            self.outputs = np.asarray(outputs, dtype=dtype)
 
-            if np.isnan(self.inputs).sum(axis=None) > 0:
+            if check_nan and contains_nan(self.inputs):
                 raise ValueError(
                     "'Not a number' (NaN) values found in input "
                     "data set provided."
                 )
 
-            if np.isnan(self.outputs).sum(axis=None) > 0:
+            if check_nan and contains_nan(self.outputs):
                 raise ValueError(
                     "'Not a number' (NaN) values found in output "
                     "data set provided."
@@ -1001,61 +1354,194 @@ class MLPTrainingData(object):
 
 
 
+    @classmethod
+    def from_file(cls, filename, ndim, name=None, mmap_mode='r',
+                  check_nan=False):
+        """Open a data set saved as a two-dimensional array in a
+        numpy .npy file (see save) as a memory-mapped array.  The
+        inputs and outputs attributes are views of the file's data
+        so only the parts of the data being used are read into
+        memory.
+
+        Arguments:
+        filename  -- name of the .npy file.
+        ndim      -- list or tuple containing the number of input
+                     and output values (see MLPTrainingData).
+
+        Keyword arguments:
+        name      -- (optional) a string to label the data set.
+        mmap_mode -- file mode used by np.load.  Default is 'r'
+                     (read-only).
+        check_nan -- If True, the whole file is read to check for
+                     NaN values.  Default is False.
+
+        Note: the data is used as it is stored in the file (it
+        cannot be normalized with the scaling option).
+        """
+
+        data = np.load(filename, mmap_mode=mmap_mode)
+
+        return cls(data=data, ndim=ndim, name=name, dtype=data.dtype,
+                   check_nan=check_nan)
+
+    def save(self, filename, chunk_size=None):
+        """Save the inputs and outputs to a numpy .npy file as one
+        two-dimensional array (inputs in the first n_in columns,
+        outputs in the last n_out columns).  The file is written
+        chunk_size rows at a time.  Use MLPTrainingData.from_file
+        to open it again.
+        """
+
+        if chunk_size is None:
+            chunk_size = default_chunk_size
+
+        m = len(self)
+        data = np.lib.format.open_memmap(
+            filename,
+            mode='w+',
+            dtype=self.dtype,
+            shape=(m, self.n_in + self.n_out)
+        )
+
+        for inputs, outputs, start, finish in self.iter_chunks(chunk_size):
+            data[start:finish, :self.n_in] = inputs
+            data[start:finish, self.n_in:] = outputs
+
+        data.flush()
+        del data
+
+    def iter_chunks(self, chunk_size=None):
+        """Iterate over the data chunk_size rows at a time.  Returns
+        a generator which yields tuples (inputs, outputs, start,
+        finish) where inputs and outputs are views (not copies) of
+        rows start to finish.
+        """
+
+        if chunk_size is None:
+            chunk_size = default_chunk_size
+
+        m = len(self)
+
+        for start in range(0, m, chunk_size):
+            finish = min(start + chunk_size, m)
+            inputs, outputs = self.take(slice(start, finish))
+            yield inputs, outputs, start, finish
+
     def split(self, ratios=(0.75, 0.25), names=('Training set',
-              'Validation set'), shuffle=True):
+              'Validation set'), shuffle=True, seed=None, stratify=False):
         """Split training data points into a number of sub-sets
         (randomly). Useful for separating training data from
         validation and test data.
 
         Once this function has been executed the training data set
-        will have an attribute called subset which is a list of
-        ndarrays of the sub-divided data.
-
-        ratios - A list or tuple containing a fraction for each
-                 desired subset.
-        names  - List or tuple of strings containing names for each
-                 sub-set.
+        will have an attribute called subsets which is a list of
+        MLPTrainingSubset objects.  The data itself is not copied
+        or re-ordered.  Each subset only stores the indices of its
+        rows (see MLPTrainingSubset).
+
+        ratios   - A list or tuple containing a fraction for each
+                   desired subset.
+        names    - List or tuple of strings containing names for each
+                   sub-set.
+        shuffle  - If True (default), rows are assigned to the
+                   subsets randomly.  Otherwise, each subset is a
+                   block of consecutive rows.
+        seed     - (optional) seed for the random number generator
+                   so that the split can be reproduced.
+        stratify - If True, each subset contains (approximately) the
+                   same proportion of each class of output values as
+                   the whole data set.  The class of each row is the
+                   index of the largest output value or, if there is
+                   only one output, the output value.
         """
 
-        if sum(ratios) != 1.0:
+        if not np.isclose(sum(ratios), 1.0):
             raise ValueError("When splitting training data into subsets,"
                              " the sum of the ratios must be 1.")
 
-        n = self.inputs.shape[0]
-        n_out = self.outputs.shape[1]
+        n = len(self)
 
         self.n_subsets = len(ratios)
 
-        num = []
-        for r in ratios:
-            num.append(int(n*r))
-        num[-1] = n - sum(num[:-1])
+        def sizes(n):
+            num = [int(n*r) for r in ratios]
+            num[-1] = n - sum(num[:-1])
+            return num
 
-        # Combine inputs and outputs into one array
-        data = np.concatenate(
-            (self.outputs, self.inputs),
-            axis=1
-        )
+        rng = np.random.RandomState(seed)
 
-        # Sort in place, randomly
-        if shuffle:
-            np.random.shuffle(data)
+        if stratify:
+
+            # Group the row indices by class and split each group
+            # separately
+            outputs = self.outputs
+            if outputs.shape[1] > 1:
+                labels = np.argmax(outputs, axis=1)
+            else:
+                labels = outputs[:, 0]
+            classes, labels = np.unique(labels, return_inverse=True)
+            order = np.argsort(labels, kind='stable')
+            counts = np.bincount(labels, minlength=len(classes))
 
-        self.outputs = data[:, :n_out]
-        self.inputs = data[:, n_out:]
+            parts = [[] for r in ratios]
+            first = 0
+            for count in counts:
+                group = order[first:first + count]
+                if shuffle:
+                    rng.shuffle(group)
+                start = 0
+                for i, r in enumerate(sizes(count)):
+                    parts[i].append(group[start:start + r])
+                    start += r
+                first += count
+
+            # Rows are kept in their original order within each
+            # subset (this is faster when reading from a file)
+            indices = [np.sort(np.concatenate(p)) for p in parts]
+
+        elif shuffle:
+            order = rng.permutation(n)
+            indices = []
+            start = 0
+            for r in sizes(n):
+                indices.append(np.sort(order[start:start + r]))
+                start += r
 
-        self.subsets = []
-        start = 0
+        else:
+            indices = []
+            start = 0
+            for r in sizes(n):
+                indices.append(slice(start, start + r))
+                start += r
+
+        self.subsets = [
+            MLPTrainingSubset(self, idx, name=names[i])
+            for i, idx in enumerate(indices)
+        ]
+
+    def take(self, indices, inputs=None, outputs=None):
+        """Returns a tuple (inputs, outputs) of the rows selected by
+        indices which may be an array of integers or a slice.  If
+        arrays are provided for inputs and outputs, the rows are
+        copied into them (this avoids creating new arrays).
+        Otherwise, selecting rows with an array of integers returns
+        copies and selecting rows with a slice returns views.
+        """
 
-        for i, r in enumerate(num):
-            finish = start + r
-            inputs = self.inputs[start:finish, :]
-            outputs = self.outputs[start:finish, :]
-            self.subsets.append(
-                MLPTrainingData(inputs=inputs, outputs=outputs,
-                                name=names[i])
-            )
-            start = finish
+        if isinstance(indices, slice):
+            if inputs is None:
+                return self.inputs[indices], self.outputs[indices]
+            inputs[:] = self.inputs[indices]
+            outputs[:] = self.outputs[indices]
+            return inputs, outputs
+
+        return (np.take(self.inputs, indices, axis=0, out=inputs),
+                np.take(self.outputs, indices, axis=0, out=outputs))
+
+    def __len__(self):
+
+        # Number of rows (training examples)
+        return self.inputs.shape[0]
 
     def __repr__(self):
 
@@ -1078,420 +1564,3400 @@ class MLPTrainingData(object):
         return "MLPTrainingData(" + ", ".join(s) + ")"
 
 
+class MLPTrainingSubset(MLPTrainingData):
+    """Subset of the rows of a training data set (MLPTrainingData)
+    created by MLPTrainingData.split.  Only the indices of the rows
+    are stored so creating a subset of a large data set does not
+    copy any data.
+
+    If the rows are a block of consecutive rows (indices is a
+    slice), inputs and outputs are views of the data.  Otherwise,
+    the rows are copied the first time the inputs or outputs
+    attributes are used.  Use take or iter_chunks to work through
+    the rows without copying the whole subset (this is what
+    train_minibatch does).
+
+    Arguments:
+    parent  -- the MLPTrainingData object containing the data.
+    indices -- array of integers or slice selecting the rows of
+               parent.
+
+    Keyword Arguments:
+    name    -- (optional) a string to label the data set.
+    """
+
+    def __init__(self, parent, indices, name=None):
+
+        self.name = name
+        self.parent = parent
+        self.indices = indices
+        self.data = None
+        self.n_in = parent.n_in
+        self.n_out = parent.n_out
+        self.dtype = parent.dtype
+        self.mu = parent.mu
+        self.sigma = parent.sigma
+        self.copies = None
+
+    @property
+    def inputs(self):
+        return self.get_arrays()[0]
+
+    @property
+    def outputs(self):
+        return self.get_arrays()[1]
+
+    def get_arrays(self):
+        """Returns a tuple (inputs, outputs) of the rows in the
+        subset.
+        """
+
+        if isinstance(self.indices, slice):
+            return self.parent.take(self.indices)
+
+        if self.copies is None:
+            self.copies = self.parent.take(self.indices)
+
+        return self.copies
+
+    def take(self, indices, inputs=None, outputs=None):
+        """Returns a tuple (inputs, outputs) of the rows of the
+        subset selected by indices (see MLPTrainingData.take).
+        The rows are read directly from the parent data set.
+        """
+
+        if isinstance(self.indices, slice):
+            rows = range(self.indices.start, self.indices.stop)
+            if isinstance(indices, slice):
+                rows = rows[indices]
+                indices = slice(rows.start, rows.stop, rows.step)
+            else:
+                indices = np.asarray(indices) + rows.start
+        else:
+            indices = self.indices[indices]
+
+        return self.parent.take(indices, inputs=inputs, outputs=outputs)
+
+    def __len__(self):
+
+        if isinstance(self.indices, slice):
+            return self.indices.stop - self.indices.start
+
+        return self.indices.shape[0]
+
+    def __repr__(self):
+
+        s = ["n=%d" % len(self)]
+        if self.name is not None:
+            s.append("name=%s" % self.name.__repr__())
+
+        return "MLPTrainingSubset(" + ", ".join(s) + ")"
+
+
+def contains_nan(x, chunk_size=None):
+    """Returns True if there are any NaN values in the array x.
+    The array is checked chunk_size rows at a time so that the
+    temporary arrays are small even if x is a very large (e.g.
+    memory-mapped) array.
+    """
+
+    if chunk_size is None:
+        chunk_size = default_chunk_size
+
+    for start in range(0, x.shape[0], chunk_size):
+        if np.isnan(x[start:start + chunk_size]).any():
+            return True
+
+    return False
+
+
 # ------------------ MLP TRAINER CLASS ----------------------
 
-# Functions and in future a class of object to manage training
+# Functions and a class of object (Trainer) to manage training
 # of one or more networks.
 
-def feed_forward(net, A, Z, theta):
+def activate(layer, Z, A, D=None):
+    """Applies the activation function of layer to Z and writes
+    the results to A.  If an array D is provided, the derivatives
+    of the activation function are written to it at the same time
+    (see fused_activation_functions).  For linear layers, A may be
+    the same array as Z in which case nothing is done.
+    """
+
+    act_func = layer.act_func[0]
 
-    m = A[0].shape[0]
+    if act_func is linear:
+        linear(Z, out=A)
+    elif act_func not in fused_activation_functions:
+        # User-defined functions may not accept an out argument
+        A[...] = act_func(Z)
+    elif D is not None:
+        fused_activation_functions[act_func](Z, A, D)
+    else:
+        act_func(Z, out=A)
+
+
+def multiply_derivatives(layer, sigma, Z, A, D=None):
+    """Multiplies sigma (in place) by the derivatives of the
+    activation function of layer.  The derivatives stored in D
+    during the feed-forward pass are used if provided.  Nothing is
+    done for linear layers.
+
+    Otherwise, for the activation functions in
+    fused_activation_functions, the derivatives are written to Z
+    (which is not needed after the feed-forward pass) so no new
+    array is created.  Only the activation functions in
+    derivatives_from_activations are used without D (see
+    initialize_arrays) and their derivatives only depend on A.
+    """
+
+    act_func = layer.act_func
+
+    if act_func[0] is linear:
+        return
+    if D is not None:
+        sigma *= D
+    elif act_func[0] in fused_activation_functions:
+        sigma *= act_func[1](Z, A, out=Z)
+    else:
+        sigma *= act_func[1](Z, A)
+
+
+def feed_forward(net, A, Z, theta, bias, D=None):
+
+    # D is an optional list of arrays to store the derivatives of
+    # the activation functions (see initialize_arrays)
+    if D is None:
+        D = [None]*net.n_layers
 
     for j, layer in enumerate(net.layers[1:], start=1):
 
         # Calculate output values of current layer based on
-        # outputs of previous layer
-        Z[j][:] = np.dot(A[j - 1], theta[j].T)
+        # outputs of previous layer.  The bias terms are added
+        # to each row (broadcast).
+        np.dot(A[j - 1], theta[j].T, out=Z[j])
+        Z[j] += bias[j]
 
         # Apply the activation function to ouput values
-        # Note: A has a column of ones if it is a hidden
-        # layer activation
-        if j == net.n_layers - 1:
-            A[j][:] = layer.act_func[0](Z[j])
-        else:
-            A[j][:,1:] = layer.act_func[0](Z[j])
+        activate(layer, Z[j], A[j], D[j])
+
+def add_scaled(y, alpha, x):
+    """Adds alpha*x to the array y in place (y += alpha*x) with the
+    BLAS axpy routine so that no temporary array is created.  If y
+    is not a C-contiguous array of floats, numpy is used instead.
+    """
+
+    if not y.flags.c_contiguous or y.dtype not in (np.float32,
+                                                   np.float64):
+        y += alpha*x
+        return
+
+    axpy = get_blas_funcs('axpy', dtype=y.dtype)
+    axpy(x.reshape(-1), y.reshape(-1), a=alpha)
 
-def back_prop(net, sigma, A, Z, theta, theta_grad, lambda_param):
+
+def back_prop(net, sigma, A, Z, theta, theta_grad, bias_grad,
+              lambda_param, D=None):
+
+    # All the results are written to the arrays provided (matrix
+    # products with out=, in-place multiplication by the derivatives
+    # and in-place scaling) so no arrays are allocated (see
+    # check_allocations).  Only user-defined activation functions
+    # (not in fused_activation_functions) create temporary arrays.
 
     m = A[0].shape[0]
 
+    if D is None:
+        D = [None]*net.n_layers
+
     # Iterate over the hidden layers to back-propagate
     # the errors
     for j in range(net.n_layers - 2, 0, -1):
-        sigma[j][:] = (
-                np.dot(sigma[j + 1], theta[j + 1][:,1:])*
-                net.layers[j].act_func[1](Z[j], A[j][:,1:])
-            )
+        np.dot(sigma[j + 1], theta[j + 1], out=sigma[j])
+        multiply_derivatives(net.layers[j], sigma[j], Z[j], A[j], D[j])
 
     # Calculate the deltas and gradients for each layer
     for j, layer in enumerate(net.layers[1:], start=1):
 
-        theta_grad[j][:] = np.dot(sigma[j].T, A[j - 1])/m
+        np.dot(sigma[j].T, A[j - 1], out=theta_grad[j])
+        np.sum(sigma[j], axis=0, out=bias_grad[j])
+        bias_grad[j] /= m
+
+        # Add component for regularization (the bias terms are
+        # not regularized).  This is done in place (see add_scaled)
+        # to avoid creating a temporary array.
+        theta_grad[j] /= m
+        if lambda_param != 0.0:
+            add_scaled(theta_grad[j], lambda_param/m, theta[j])
+
+
+def weight_views(net, weights):
+    """Returns a tuple (theta, bias) of two lists of views of
+    weights (an array the last dimension of which has length
+    net.n_weights).  theta[j] contains the weights applied to the
+    inputs of layer j with shape (..., n_nodes, number of inputs)
+    and bias[j] contains the bias terms of layer j with shape
+    (..., n_nodes).  The first items are None because there are no
+    weights in the input layer.
+
+    The weights of each layer are stored in turn: first the weights
+    applied to the inputs (row by row) and then the bias terms.
+    The same layout is used for the gradients.
+    """
+
+    lead = weights.shape[:-1]
+    theta = [None]
+    bias = [None]
+
+    first = 0
+    previous = net.layers[0]
+    for j, layer in enumerate(net.layers[1:], start=1):
+        last = first + layer.n_nodes*previous.n_nodes
+        theta.append(
+            weights[..., first:last].reshape(
+                lead + (layer.n_nodes, previous.n_nodes)
+            )
+        )
+        first, last = last, last + layer.n_nodes
+        bias.append(weights[..., first:last])
+        previous = layer
+        first = last
+
+    if first != weights.shape[-1]:
+        raise MLPError("Error: weights array is not the correct size "
+                       "for the network.")
+
+    return theta, bias
+
+
+def initialize_input_array(m, n_in, dtype, training_data=None):
+    """Returns the array A[0] of inputs used to calculate the
+    outputs of the first layer.  If the inputs of training_data
+    have the same size and data type, they are returned themselves
+    (not a copy).  Otherwise a new array is created and the inputs
+    of training_data (if provided) are copied into it.
+    """
+
+    if training_data is not None:
+        inputs = training_data.inputs
+        if inputs.shape == (m, n_in) and inputs.dtype == dtype:
+            return inputs
 
-        # Add component for regularization
-        theta_grad[j][:, 1:] += lambda_param*theta[j][:, 1:]/m
+    A0 = np.empty((m, n_in), dtype=dtype)
+    if training_data is not None:
+        A0[:] = training_data.inputs
 
+    return A0
 
-def initialize_arrays(net, m):
+
+def initialize_arrays(net, m, dtype=None, jac=True, memoize=False,
+                      training_data=None, lean=False):
 
     # m is number of training data points
 
+    # If training_data is provided, A[0] is set to its inputs.  If
+    # they have the same data type they are used without copying
+    # (see initialize_input_array).  A[0] is never written to by
+    # the cost functions.
+
+    # If jac is False, only the arrays needed to calculate the
+    # cost function (A and Z) are created.  The arrays needed to
+    # calculate the gradients (sigma, grad, theta_grad, bias_grad
+    # and D) are set to None.  Instead, 'work' is a list of two
+    # arrays the size of the outputs which the cost functions use
+    # to calculate the cost without creating temporary arrays (with
+    # jac True, they use sigma[-1] and D[-1] and 'work' is None).
+
+    # D[j] is an array to store the derivatives of the activation
+    # function of layer j calculated during the feed-forward pass.
+    # It is None for linear layers (derivatives are all 1.0) and for
+    # activation functions that have no fused function (see
+    # fused_activation_functions).  For linear layers A[j] is the
+    # same array as Z[j].
+
+    # If lean is True, less memory is used.  The hidden layers with
+    # an activation function in fused_activation_functions do not
+    # keep their pre-activations.  Z[j] of these layers are views of
+    # one scratch array (the size of the widest of them) which is
+    # over-written by the next layer.  Derivatives are only stored
+    # (in D) for the layers that need Z to calculate them (e.g.
+    # arctan, relu).  For the layers with an activation function in
+    # derivatives_from_activations (sigmoid, tanh) they are
+    # calculated from A during back-propagation.  Z of the output
+    # layer is always kept.
+
+    # If memoize is True, the cache also contains a dictionary
+    # 'memo' used by the cost functions to remember the last
+    # evaluation (see initialize_memo).
+
+    # Arrays have the same data type as the network unless
+    # specified
+    if dtype is None:
+        dtype = net.dtype
+
     # Set-up matrices needed for vectorized training
 
     # Prepare list variables for feed-forward computations
     A = [None]*net.n_layers
     Z = [None]*net.n_layers
 
-    # Make each A with a column of ones to simulate the
-    # bias terms
+    # Hidden layers that use the scratch array for Z in lean mode
+    scratch_layers = lean_scratch_layers(net) if lean else []
+    if scratch_layers:
+        scratch = np.empty(m*max(net.dimensions[j] for j in
+                                 scratch_layers), dtype=dtype)
+
     for j, layer in enumerate(net.layers):
 
-        # Prepare matrices for output values:
-        if j > 0:
-            Z[j] = np.empty((m, layer.n_nodes))
+        # Prepare matrices for output values (contiguous views of
+        # the scratch array in lean mode):
+        if j in scratch_layers:
+            Z[j] = scratch[:m*layer.n_nodes].reshape(m, layer.n_nodes)
+        elif j > 0:
+            Z[j] = np.empty((m, layer.n_nodes), dtype=dtype)
 
         # Prepare matrices for A:
-        if j == net.n_layers - 1:
-            A[j] = np.empty((m, layer.n_nodes))
+        if j == 0:
+            A[j] = initialize_input_array(m, layer.n_nodes, dtype,
+                                          training_data)
+        elif layer.act_func[0] is linear:
+            A[j] = Z[j]
         else:
-            A[j] = np.concatenate(
-                (
-                    np.ones((m, 1), dtype=np.float),
-                    np.empty((m, layer.n_nodes))
-                ),
-                axis=1
-            )
-
-    # Prepare array for gradients with the same
-    # dimensions as weights
-    grad = np.zeros(net.n_weights, dtype=np.float)
+            A[j] = np.empty((m, layer.n_nodes), dtype=dtype)
 
-    # Partial derivatives of error w.r.t. each weight
-    theta_grad = [None]*net.n_layers
+    memo = initialize_memo(net) if memoize else None
 
-    # Changes to each weight
-    # TODO: Don't really need this cache
-    #delta = [None]*net.n_layers
-
-    # Now initialise gradient and delta arrays
-    first = 0
-    previous = net.layers[0]
+    if not jac:
+        return {
+            'A': A,
+            'Z': Z,
+            'sigma': None,
+            'grad': None,
+            'theta_grad': None,
+            'bias_grad': None,
+            'D': None,
+            'work': [np.empty((m, net.n_outputs), dtype=dtype)
+                     for i in range(2)],
+            'memo': memo
+        }
 
+    # Derivatives of the activation functions
+    D = [None]*net.n_layers
     for j, layer in enumerate(net.layers[1:], start=1):
-        last = first + previous.n_outputs*(layer.n_outputs - 1)
-        if last > net.n_weights:
-            raise MLPError(
-                "Error initialising indices of gradients arrays."
-            )
+        if layer.act_func[0] not in fused_activation_functions:
+            continue
+        if j in scratch_layers and \
+                layer.act_func[0] in derivatives_from_activations:
+            continue
+        D[j] = np.empty((m, layer.n_nodes), dtype=dtype)
 
-        try:
-            theta_grad[j] = grad[first:last].reshape((layer.n_outputs \
-                            - 1, previous.n_outputs))
-        except:
-            raise MLPError(
-                "Error re-shaping the array of gradients "
-                " for layer" + str(j)
-            )
+    # Prepare array for gradients with the same
+    # dimensions as weights
+    grad = np.zeros(net.n_weights, dtype=dtype)
 
-        previous = layer
-        first = last
+    # Partial derivatives of error w.r.t. each weight and bias
+    # term (views of grad)
+    theta_grad, bias_grad = weight_views(net, grad)
 
     # Errors at each node
     sigma = [None]*net.n_layers
 
     for j in range(net.n_layers - 1, 0, -1):
-        sigma[j] = np.empty((m, net.layers[j].n_nodes))
+        sigma[j] = np.empty((m, net.layers[j].n_nodes), dtype=dtype)
 
     return {
         'A': A,
         'Z': Z,
         'sigma': sigma,
         'grad': grad,
-        'theta_grad': theta_grad
+        'theta_grad': theta_grad,
+        'bias_grad': bias_grad,
+        'D': D,
+        'work': None,
+        'memo': memo
     }
 
-def train(net, training_data, max_iter=1, update=True, disp=False,
-          method='L-BFGS-B', lambda_param=0.0, gtol=1e-6, ftol=0.01):
-    """Trains a network (net) on a set of training data (data) using
-    the scipy.optimize.minimize function which will minimize
-    the cost function (net.cost_function) by changing the weights
-    (net.weights).
 
-    Returns a scipy.optimize.OptimizeResult object. See the scipy
-    documentation for a description of its attributes.
+def lean_scratch_layers(net):
+    """Returns the list of the indices of the hidden layers which do
+    not keep their pre-activations (Z) in lean arrays (see
+    initialize_arrays).
+    """
 
-    Arguments:
-    net           -- MLPNetwork object.
-    training_data -- MLPTrainingData object.
+    return [j for j, layer in enumerate(net.layers[1:-1], start=1)
+            if layer.act_func[0] in fused_activation_functions]
 
-    Keyword Arguments:
-    max_iter     -- Maximum number of iterations of the solver
-    update       -- Set to False if you don't want to update the
-                    network's weights at the end of the training.
-                    Default is True.
-    disp         -- Set to True if you want the minimize function to
-                    print convergence progress messages during the
-                    training.
-    method       -- Select the solver to use.  It must be a solver
-                    that uses a Jacobian matrix (of gradients).
-                    Default is 'L-BFGS-B'.
-    lambda_param -- Regularization parameter.  Default is 0.0.
-    gtol         -- This is a parameter specific to the 'L-BFGS-B'
-                    solver.  The iteration will stop when the
-                    maximum gradient is <= gtol.  Default is 1e-6.
-    ftol         -- This is a parameter specific to the 'L-BFGS-B'
-                    solver.  The iteration will stop when the cost
-                    function is <= to ftol.  Default is 0.01.
+
+def initialize_memo(net):
+    """Returns a dictionary used by the cost functions to remember
+    the weights, lambda_param and cost (J) of the last evaluation
+    with a cache.  If the cost function is called again with the
+    same cache, weights and lambda_param, the cost and gradients
+    (which are still in cache['grad']) are returned without
+    repeating the feed-forward and back-propagation computations.
+    The number of times this happens is counted in 'hits'.
+
+    The weights are compared element by element with a copy (not
+    a hash) so a different set of weights is never mistaken for the
+    last one.
     """
 
-    # Number of training examples
-    m = training_data.inputs.shape[0]
+    return {
+        'weights': np.empty_like(net.weights),
+        'valid': False,
+        'lambda_param': None,
+        'J': None,
+        'jac': False,
+        'hits': 0
+    }
 
-    assert training_data.outputs.shape[0] == m
 
-    # Prepare arrays (empty)
-    # A, Z, sigma, grad, theta_grad
-    arrays = initialize_arrays(net, m)
+def memo_lookup(cache, weights, lambda_param, jac):
+    """Returns the result of the last evaluation of the cost
+    function with cache ((J, grad) or J if jac is False) if it was
+    done with the same weights and lambda_param.  Otherwise
+    returns None.
+    """
 
-    # Assign training data inputs to A[0]
-    arrays['A'][0][:, 1:] = training_data.inputs
+    memo = cache.get('memo')
+    if memo is None or not memo['valid']:
+        return None
 
-    cost_func = partial(
-        net.cost_function,
-        net,
-        training_data,
-        lambda_param=lambda_param,
-        jac=True,
-        cache=arrays
-    )
+    if memo['lambda_param'] != lambda_param or (jac and not memo['jac']):
+        return None
 
-    # Run solver
-    res = minimize(
-        cost_func,
-        net.weights,
-        method=method,
-        jac=True,
-        options={
-            'gtol': gtol,
-            'ftol': ftol*np.finfo(float).eps,
-            'disp': disp,
-            'maxiter': max_iter
-        }
-    )
-    # Other solver methods:
-    # - CG, BFGS, Newton-CG, L-BFGS-B, TNC, SLSQP, dogleg, trust-ncg
+    if not np.array_equal(weights, memo['weights']):
+        return None
 
-    if update:
-        net.weights[:] = res.x
+    memo['hits'] += 1
 
-    # Transfer the normalization coefficients used in training to the
-    # network so they can be used later for prediction.
-    net.mu, net.sigma = training_data.mu, training_data.sigma
+    if jac:
+        return (memo['J'], cache['grad'])
+    return memo['J']
 
-    print("Solver returned the following message:\n%s" % str(res.message))
 
-    return res
+def memo_store(cache, weights, lambda_param, J, jac):
+    """Remembers the result of an evaluation of the cost function
+    (if the cache has a memo).
+    """
 
+    memo = cache.get('memo')
+    if memo is None:
+        return
 
-def cost_function_log(net, training_data, weights=None,
+    memo['weights'][:] = weights
+    memo['valid'] = True
+    memo['lambda_param'] = lambda_param
+    memo['J'] = J
+    memo['jac'] = bool(jac)
+
+
+def array_bytes_per_row(net, dtype=None, jac=True, lean=False):
+    """Returns the number of bytes of the arrays created by
+    initialize_arrays for each row of training data, including one
+    temporary array the width of the widest layer.
+    """
+
+    if dtype is None:
+        dtype = net.dtype
+
+    scratch_layers = lean_scratch_layers(net) if lean else []
+
+    n = net.n_inputs + max(net.dimensions)
+    if scratch_layers:
+        n += max(net.dimensions[j] for j in scratch_layers)
+    for j, layer in enumerate(net.layers[1:], start=1):
+        act_func = layer.act_func[0]
+        n_arrays = 0 if j in scratch_layers else 1
+        if act_func is not linear:
+            n_arrays += 1
+        if jac:
+            n_arrays += 1
+            if act_func in fused_activation_functions and not (
+                    j in scratch_layers and
+                    act_func in derivatives_from_activations):
+                n_arrays += 1
+        n += n_arrays*layer.n_nodes
+
+    # Work arrays for the cost function without the gradients
+    if not jac:
+        n += 2*net.n_outputs
+
+    return n*np.dtype(dtype).itemsize
+
+
+def budget_chunk_size(net, memory_budget=None, dtype=None, jac=True,
+                      lean=False):
+    """Returns the largest number of rows of training data that the
+    arrays created by initialize_arrays (including the gradients)
+    can hold within memory_budget bytes.  Default is
+    default_memory_budget.  Raises a ValueError if the budget is
+    too small for one row.
+    """
+
+    if memory_budget is None:
+        memory_budget = default_memory_budget
+    if dtype is None:
+        dtype = net.dtype
+
+    # The gradients of a chunk and the total gradients
+    fixed = 2*net.n_weights*np.dtype(dtype).itemsize if jac else 0
+    chunk_size = (memory_budget - fixed)//array_bytes_per_row(net, dtype,
+                                                              jac, lean)
+    if chunk_size < 1:
+        raise ValueError("memory_budget of %d bytes is too small for "
+                         "one row of training data." % memory_budget)
+
+    return int(chunk_size)
+
+
+def initialize_chunked_arrays(net, m, memory_budget=None,
+                              chunk_size=None, dtype=None, jac=True,
+                              memoize=False, lean=False):
+    """Returns a dictionary of arrays used by the cost functions to
+    calculate the cost function and gradients on m rows of training
+    data in chunks of chunk_size rows.  Only one set of arrays for
+    chunk_size rows (created by initialize_arrays) is used so the
+    memory needed does not depend on m.  The results are exactly the
+    same as with the arrays for all m rows.
+
+    Keyword arguments:
+    memory_budget -- maximum size of the arrays in bytes.  Used to
+                     choose chunk_size if it is not provided (see
+                     budget_chunk_size).  Default is
+                     default_memory_budget.
+    chunk_size    -- number of rows in each chunk.
+    dtype         -- data type of the arrays.  Default is the data
+                     type of the network.
+    jac           -- if False, only the arrays needed to calculate
+                     the cost function are created.
+    memoize       -- if True, the cache contains a memo (see
+                     initialize_memo).
+    lean          -- if True, the arrays of a chunk use less memory
+                     (see initialize_arrays) so chunks can be larger.
+
+    The dictionary contains:
+    'chunk_size' -- number of rows in each chunk.
+    'chunk'      -- the arrays for one chunk (see initialize_arrays).
+                    Its A[0] is used to hold the inputs of a chunk
+                    when the training data have a different data
+                    type.
+    'grad', 'theta_grad', 'bias_grad' -- the total gradients.
+    'memo'       -- the memo or None.
+    """
+
+    if dtype is None:
+        dtype = net.dtype
+    if chunk_size is None:
+        chunk_size = budget_chunk_size(net, memory_budget, dtype, jac,
+                                       lean)
+    chunk_size = max(1, min(chunk_size, m))
+
+    cache = {
+        'chunk_size': chunk_size,
+        'chunk': initialize_arrays(net, chunk_size, dtype=dtype, jac=jac,
+                                   lean=lean),
+        'grad': None,
+        'theta_grad': None,
+        'bias_grad': None,
+        'memo': initialize_memo(net) if memoize else None
+    }
+
+    if jac:
+        cache['grad'] = np.zeros(net.n_weights, dtype=dtype)
+        cache['theta_grad'], cache['bias_grad'] = \
+            weight_views(net, cache['grad'])
+
+    return cache
+
+
+def initialize_training_arrays(net, training_data, memory_budget=None,
+                               memoize=False, lean=False):
+    """Returns the arrays used by the cost functions to calculate
+    the cost function and gradients on all of training_data.  If the
+    arrays for all the rows fit within memory_budget bytes (default
+    is default_memory_budget), they are created by
+    initialize_arrays.  Otherwise the rows are processed in chunks
+    (see initialize_chunked_arrays).  If lean is True, lean arrays
+    are used (see initialize_arrays).
+    """
+
+    if memory_budget is None:
+        memory_budget = default_memory_budget
+
+    m = len(training_data)
+    size = m*array_bytes_per_row(net, lean=lean) + \
+           2*net.n_weights*net.dtype.itemsize
+
+    if size <= memory_budget:
+        return initialize_arrays(net, m, memoize=memoize,
+                                 training_data=training_data, lean=lean)
+
+    return initialize_chunked_arrays(net, m, memory_budget=memory_budget,
+                                     memoize=memoize, lean=lean)
+
+
+def initialize_predict_arrays(net, m):
+    """Returns a dictionary of arrays needed by MLPNetwork.predict
+    to calculate the outputs of the network for m sets of inputs
+    without allocating any new arrays.  The same arrays can be
+    re-used for any number of calls to predict with m inputs.
+
+    Example:
+    >>> cache = initialize_predict_arrays(net, m)
+    >>> y_hat = net.predict(x, cache=cache, copy=False)
+    """
+
+    # A[0] holds the normalized inputs and A[j] holds the outputs
+    # of layer j
+    A = [np.empty((m, layer.n_nodes), dtype=net.dtype)
+         for layer in net.layers]
+
+    return {
+        'A': A
+    }
+
+
+def memory_plan(net, m, dtype=None, jac=True, memory_budget=None,
+                optimizer='adam', lean=False):
+    """Returns a dictionary of the number of bytes allocated by each
+    stage of training and using a network with m rows of data,
+    without creating any arrays.  Use it to choose the size of data
+    sets, chunks and mini-batches for the memory available.
+
+    Arguments:
+    net -- MLPNetwork object.
+    m   -- number of rows (training examples or inputs).
+
+    Keyword arguments:
+    dtype         -- data type of the arrays.  Default is the data
+                     type of the network.
+    jac           -- if False, the arrays needed for the gradients
+                     are not included.
+    memory_budget -- target maximum number of bytes used to
+                     recommend the chunk and batch sizes.  Default is
+                     default_memory_budget.
+    optimizer     -- update rule used by train_minibatch (see
+                     optimizers).  Default is 'adam'.
+    lean          -- if True, the sizes of lean arrays are returned
+                     (see initialize_arrays).
+
+    The dictionary contains:
+    'weights'     -- one copy of the network's weights.
+    'grad'        -- the gradients.
+    'inputs'      -- A[0] if the inputs are copied (they are used
+                     without copying when the data type matches, see
+                     initialize_input_array).
+    'A', 'Z', 'sigma', 'D', 'work' -- the other arrays created by
+                     initialize_arrays for m rows.
+    'arrays'      -- total of the arrays created by initialize_arrays
+                     (without 'inputs').
+    'predict'     -- peak bytes allocated by net.predict for m inputs
+                     without a cache (temporaries and the outputs
+                     returned).
+    'predict_cache' -- arrays created by initialize_predict_arrays.
+    'split'       -- peak bytes allocated by
+                     MLPTrainingData.split with shuffle=True (the
+                     row indices of the subsets).
+    'split_copies' -- rows copied when the inputs and outputs of all
+                     the subsets created by split (with shuffle=True)
+                     are used.
+    'chunk_size'  -- largest chunk size for the cost functions within
+                     memory_budget (see budget_chunk_size).
+    'batch_size'  -- largest mini-batch size for train_minibatch
+                     within memory_budget.
+    'memory_budget' -- the budget used.
+    """
+
+    if dtype is None:
+        dtype = net.dtype
+    if memory_budget is None:
+        memory_budget = default_memory_budget
+    itemsize = np.dtype(dtype).itemsize
+    n_weights = net.n_weights*itemsize
+
+    # In lean arrays, the Z of some hidden layers share one scratch
+    # array
+    scratch_layers = lean_scratch_layers(net) if lean else []
+
+    plan = {'A': 0, 'Z': 0, 'sigma': 0, 'D': 0}
+    if scratch_layers:
+        plan['Z'] = m*max(net.dimensions[j]
+                          for j in scratch_layers)*itemsize
+    for j, layer in enumerate(net.layers[1:], start=1):
+        act_func = layer.act_func[0]
+        size = m*layer.n_nodes*itemsize
+        if j not in scratch_layers:
+            plan['Z'] += size
+        if act_func is not linear:
+            plan['A'] += size
+        if jac and act_func in fused_activation_functions and not (
+                j in scratch_layers and
+                act_func in derivatives_from_activations):
+            plan['D'] += size
+        if jac:
+            plan['sigma'] += size
+    plan['work'] = 0 if jac else 2*m*net.n_outputs*itemsize
+    plan['arrays'] = plan['A'] + plan['Z'] + plan['sigma'] + plan['D'] + \
+                     plan['work']
+    plan['weights'] = n_weights
+    plan['grad'] = n_weights if jac else 0
+    plan['inputs'] = m*net.n_inputs*itemsize
+
+    # predict normalizes the inputs (one temporary array) then keeps
+    # the inputs and outputs of one layer at a time
+    widths = net.dimensions
+    plan['predict'] = m*itemsize*max(
+        [2*widths[0]] + [widths[j - 1] + widths[j]
+                         for j in range(1, len(widths))]
+    )
+    plan['predict_cache'] = m*sum(widths)*itemsize
+
+    # split keeps a permutation and the sorted indices of each subset
+    index_size = np.dtype(np.intp).itemsize
+    plan['split'] = 2*m*index_size
+    plan['split_copies'] = m*(net.n_inputs + net.n_outputs)*itemsize
+
+    plan['chunk_size'] = budget_chunk_size(net, memory_budget, dtype, jac,
+                                           lean)
+
+    # train_minibatch copies the weights, keeps the optimizer state and
+    # one set of arrays and outputs for a mini-batch
+    n_state = {'sgd': 0, 'momentum': 1, 'adam': 3}.get(optimizer, 3)
+    fixed = (2 + n_state)*n_weights
+    row = array_bytes_per_row(net, dtype, lean=lean) + \
+          net.n_outputs*itemsize
+    plan['batch_size'] = max(0, int((memory_budget - fixed)//row))
+    plan['memory_budget'] = memory_budget
+
+    return plan
+
+
+def print_memory_plan(plan):
+    """Prints the dictionary returned by memory_plan."""
+
+    for key, value in plan.items():
+        if key in ('chunk_size', 'batch_size'):
+            print("%-14s %12d rows" % (key, value))
+        else:
+            print("%-14s %12.3f MB" % (key, value/2**20))
+
+
+def train(net, training_data, max_iter=1, update=True, disp=False,
+          method='L-BFGS-B', lambda_param=0.0, gtol=1e-6, ftol=0.01,
+          messages=True, validation_data=None, eval_interval=1,
+          patience=None, restore_best=True, objective=None,
+          memory_budget=None, lean=False):
+    """Trains a network (net) on a set of training data (data) using
+    the scipy.optimize.minimize function which will minimize
+    the cost function (net.cost_function) by changing the weights
+    (net.weights).
+
+    Returns a scipy.optimize.OptimizeResult object. See the scipy
+    documentation for a description of its attributes.
+
+    Arguments:
+    net           -- MLPNetwork object.
+    training_data -- MLPTrainingData object.
+
+    Keyword Arguments:
+    max_iter     -- Maximum number of iterations of the solver
+    update       -- Set to False if you don't want to update the
+                    network's weights at the end of the training.
+                    Default is True.
+    disp         -- Set to True if you want the minimize function to
+                    print convergence progress messages during the
+                    training.
+    method       -- Select the solver to use.  It must be a solver
+                    that uses a Jacobian matrix (of gradients).
+                    Default is 'L-BFGS-B'.
+    lambda_param -- Regularization parameter.  Default is 0.0.
+    gtol         -- This is a parameter specific to the 'L-BFGS-B'
+                    solver.  The iteration will stop when the
+                    maximum gradient is <= gtol.  Default is 1e-6.
+    ftol         -- This is a parameter specific to the 'L-BFGS-B'
+                    solver.  The iteration will stop when the cost
+                    function is <= to ftol.  Default is 0.01.
+    messages     -- Set to False to stop the message returned by the
+                    solver being printed.  Default is True.
+    validation_data -- (optional) MLPTrainingData object.  If
+                    provided, the cost on this data is calculated
+                    every eval_interval iterations of the solver and
+                    the weights with the lowest cost are kept (see
+                    EarlyStopping).
+    eval_interval -- Number of iterations between evaluations of the
+                    validation cost.  Default is 1.
+    patience     -- (optional) stop training if the validation cost
+                    has not improved for this number of evaluations.
+    restore_best -- If True (default) and validation_data was
+                    provided, the weights with the lowest validation
+                    cost are returned (res.x) instead of the final
+                    weights.  The lowest cost and the iteration when
+                    it occurred are returned in res.best_cost and
+                    res.best_iter.
+    objective    -- (optional) function or object which returns a
+                    tuple (J, grad) of the cost function and
+                    gradients for a one-dimensional array of weights
+                    (e.g. ThreadedCostFunction).  If provided, it is
+                    used instead of net.cost_function and
+                    lambda_param is not used (the objective applies
+                    its own regularization).
+    memory_budget -- (optional) maximum size in bytes of the arrays
+                    used to calculate the cost function.  If the
+                    arrays for all the training data would be larger,
+                    the data are processed in chunks of rows (see
+                    initialize_training_arrays).  The results are
+                    the same.  Default is default_memory_budget.
+    lean         -- If True, arrays that use less memory are used to
+                    calculate the cost function (see
+                    initialize_arrays).  The results are the same.
+
+    The number of times the solver evaluated the cost function
+    with the same weights as the previous evaluation (and the
+    result was not calculated again) is returned in res.memo_hits.
+    """
+
+    # Number of training examples
+    m = training_data.inputs.shape[0]
+
+    assert training_data.outputs.shape[0] == m
+
+    if objective is None:
+
+        # Prepare arrays (empty)
+        # A, Z, sigma, grad, theta_grad, bias_grad.  The solver
+        # sometimes evaluates the cost function more than once with
+        # the same weights so the last result is remembered.
+        arrays = initialize_training_arrays(net, training_data,
+                                            memory_budget=memory_budget,
+                                            memoize=True, lean=lean)
+
+        objective = partial(
+            net.cost_function,
+            net,
+            training_data,
+            lambda_param=lambda_param,
+            jac=True,
+            cache=arrays
+        )
+    else:
+        arrays = getattr(objective, 'cache', None)
+
+    # The solver does not always provide the weights in the same
+    # array so they are copied into one array.  This way
+    # net.get_layer_params only needs to create the arrays of weights
+    # for each layer once.
+    weights = np.empty_like(net.weights)
+
+    def cost_func(x):
+        weights[:] = x
+        return objective(weights=weights)
+
+    callback = None
+    if validation_data is not None:
+        stopping = EarlyStopping(net, validation_data,
+                                 eval_interval=eval_interval,
+                                 patience=patience)
+
+        def callback(xk):
+            if stopping.update(xk):
+                raise StopIteration
+
+    # Run solver
+    try:
+        res = minimize(
+            cost_func,
+            net.weights,
+            method=method,
+            jac=True,
+            callback=callback,
+            options={
+                'gtol': gtol,
+                'ftol': ftol*np.finfo(float).eps,
+                'disp': disp,
+                'maxiter': max_iter
+            }
+        )
+    except StopIteration:
+        # Older versions of scipy do not stop the solver when the
+        # callback function raises StopIteration
+        res = OptimizeResult(
+            x=stopping.weights.copy(),
+            nit=stopping.n_iter,
+            success=False,
+            status=99,
+            message="`callback` raised `StopIteration`."
+        )
+    # Other solver methods:
+    # - CG, BFGS, Newton-CG, L-BFGS-B, TNC, SLSQP, dogleg, trust-ncg
+
+    if validation_data is not None:
+        if stopping.stopped:
+            res.message = "Validation cost did not improve for %d " \
+                          "evaluations." % patience
+        if restore_best and stopping.best_iter is not None:
+            res.x = stopping.best_weights.copy()
+        res.best_cost = stopping.best_cost
+        res.best_iter = stopping.best_iter
+
+    # Number of evaluations of the cost function that were not
+    # repeated
+    memo = None if arrays is None else arrays.get('memo')
+    res.memo_hits = 0 if memo is None else memo['hits']
+
+    if update:
+        net.weights[:] = res.x
+
+    # Transfer the normalization coefficients used in training to the
+    # network so they can be used later for prediction.
+    net.mu, net.sigma = training_data.mu, training_data.sigma
+
+    if messages:
+        print("Solver returned the following message:\n%s" %
+              str(res.message))
+
+    return res
+
+
+def lbfgs_direction(g, s, y):
+    """Returns the L-BFGS search direction (two-loop recursion) for
+    the gradients g and the sequences s and y of the previous steps
+    and changes in the gradients (oldest first).  Used by Trainer
+    and train_stack.
+    """
+
+    q = -g
+    alphas = []
+    for s_i, y_i in zip(reversed(s), reversed(y)):
+        alpha = np.dot(s_i, q)/np.dot(y_i, s_i)
+        q -= alpha*y_i
+        alphas.append(alpha)
+
+    if s:
+        q *= np.dot(s[-1], y[-1])/np.dot(y[-1], y[-1])
+    else:
+        # No curvature information yet so take a small step
+        # in the steepest-descent direction
+        q /= max(1.0, np.linalg.norm(q))
+
+    for s_i, y_i, alpha in zip(s, y, reversed(alphas)):
+        beta = np.dot(y_i, q)/np.dot(y_i, s_i)
+        q += (alpha - beta)*s_i
+
+    return q
+
+
+class Trainer(object):
+    """Object to manage the training of a network on a set of
+    training data over many calls to its train method.
+
+    Unlike the function train, which sets up new arrays and starts
+    the solver from scratch each time it is called, a Trainer keeps
+    the arrays used to compute the cost function and the state of
+    its solver (the current weights, cost, gradients and the
+    curvature information of the L-BFGS algorithm) between calls.
+    This means a network can be trained in chunks of iterations
+    (for example to check the cost on validation data in between)
+    with the same result as training it in one go.
+
+    The solver is a limited-memory BFGS (L-BFGS) algorithm using
+    the Wolfe line search from scipy.optimize.
+
+    Arguments:
+    net           -- MLPNetwork object.
+    training_data -- MLPTrainingData object.
+
+    Keyword Arguments:
+    lambda_param  -- Regularization parameter.  Default is 0.0.
+    memory        -- number of previous steps used by the L-BFGS
+                     algorithm to approximate the curvature of the
+                     cost function.  Default is 10.
+    gtol          -- The training will stop when the maximum
+                     gradient is <= gtol.  Default is 1e-6.
+    ftol          -- The training will stop when the relative
+                     reduction in the cost function is <=
+                     ftol*(machine epsilon).  Default is 0.01.
+    validation_data -- (optional) MLPTrainingData object.  If
+                     provided, the cost on this data is calculated
+                     every eval_interval iterations and the weights
+                     with the lowest cost are kept (see
+                     EarlyStopping).  If the validation cost has not
+                     improved for patience evaluations, the training
+                     stops and the network's weights are set to the
+                     best weights.  Calling train again continues
+                     from the best weights.
+    eval_interval, patience -- see validation_data.
+    memory_budget -- (optional) maximum size in bytes of the arrays
+                     used to calculate the cost function.  If the
+                     arrays for all the training data would be larger,
+                     the data are processed in chunks of rows (see
+                     initialize_training_arrays).  The results are
+                     the same.  Default is default_memory_budget.
+    lean          -- If True, arrays that use less memory are used to
+                     calculate the cost function (see
+                     initialize_arrays).  The results are the same.
+
+    Attributes:
+    net, training_data, lambda_param, memory, gtol, ftol -- as above.
+    stopping -- EarlyStopping object (None if no validation_data
+                was provided).
+    cache    -- the arrays used to compute the cost function (see
+                initialize_training_arrays).
+    x        -- the current weights of the solver (np.float64).
+    f, g     -- the cost and gradients at x (None before the first
+                call to train).
+    n_iter   -- total number of iterations of the solver.
+    n_eval   -- total number of evaluations of the cost function
+                (not including evaluations at the same weights as
+                the previous one, which are counted in
+                cache['memo']['hits']).
+
+    Methods:
+    train    -- run the solver for a number of iterations.
+    cost     -- compute the cost function and gradients for a set of
+                weights.
+    reset    -- discard the curvature information of the solver.
+    """
+
+    def __init__(self, net, training_data, lambda_param=0.0, memory=10,
+                 gtol=1e-6, ftol=0.01, validation_data=None,
+                 eval_interval=1, patience=None, memory_budget=None,
+                 lean=False):
+
+        self.net = net
+        self.training_data = training_data
+        self.lambda_param = lambda_param
+        self.memory = memory
+        self.gtol = gtol
+        self.ftol = ftol
+
+        m = training_data.inputs.shape[0]
+        assert training_data.outputs.shape[0] == m
+
+        # Prepare arrays (A, Z, sigma, grad, theta_grad, bias_grad)
+        # once.  The line search evaluates the cost and the gradients
+        # separately at the same points so the last result is
+        # remembered (see initialize_memo).
+        self.cache = initialize_training_arrays(net, training_data,
+                                                memory_budget=memory_budget,
+                                                memoize=True, lean=lean)
+
+        # Weights used to compute the cost function (same data
+        # type as the network)
+        self.weights = np.empty_like(net.weights)
+
+        # Copy of the network's weights when the trainer last read
+        # them or wrote to them.  Used to detect changes made to the
+        # weights outside the trainer.
+        self._net_weights = net.weights.copy()
+
+        # State of the solver
+        self.x = net.weights.astype(np.float64)
+        self.f = None
+        self.g = None
+        self.f_previous = None
+        self.s = deque(maxlen=memory)
+        self.y = deque(maxlen=memory)
+        self.n_iter = 0
+        self.n_eval = 0
+
+        # Gradients of the last evaluation
+        self.g_eval = np.empty(net.n_weights, dtype=np.float64)
+
+        self.stopping = None
+        if validation_data is not None:
+            self.stopping = EarlyStopping(net, validation_data,
+                                          eval_interval=eval_interval,
+                                          patience=patience)
+
+    def cost(self, x):
+        """Returns a tuple (J, grad) of the cost function and
+        gradients for the weights x.  If x is the same as the last
+        weights evaluated, the results are not calculated again.
+        Note: grad is over-written by the next evaluation.
+        """
+
+        memo = self.cache['memo']
+        hits = memo['hits']
+
+        self.weights[:] = x
+        J, grad = self.net.cost_function(
+            self.net,
+            self.training_data,
+            weights=self.weights,
+            lambda_param=self.lambda_param,
+            jac=True,
+            cache=self.cache
+        )
+        if memo['hits'] == hits:
+            self.n_eval += 1
+            self.g_eval[:] = grad
+
+        return float(J), self.g_eval
+
+    def reset(self):
+        """Discard the curvature information of the solver.  The
+        next iteration will be a steepest-descent step.
+        """
+
+        self.s.clear()
+        self.y.clear()
+        self.f_previous = None
+
+    def direction(self):
+        """Returns the L-BFGS search direction (see
+        lbfgs_direction).
+        """
+
+        return lbfgs_direction(self.g, self.s, self.y)
+
+    def train(self, max_iter=1, update=True, messages=False):
+        """Run the solver for up to max_iter iterations continuing
+        from where the last call finished.
+
+        If the network's weights were changed since the last call
+        (e.g. using set_weights), the solver starts again from the
+        new weights.
+
+        Returns a scipy.optimize.OptimizeResult object (see train).
+
+        Keyword Arguments:
+        max_iter -- Maximum number of iterations of the solver.
+        update   -- Set to False if you don't want to update the
+                    network's weights at the end of the training.
+                    Default is True.
+        messages -- Set to True to print the reason the solver
+                    stopped.
+        """
+
+        net = self.net
+
+        # Start again if the network's weights have been changed
+        # (the network's weights are different from self.x after
+        # training with update=False)
+        if self.g is None or not np.array_equal(net.weights,
+                                                self._net_weights):
+            self._net_weights[:] = net.weights
+            self.x = net.weights.astype(np.float64)
+            self.reset()
+            f, g = self.cost(self.x)
+            self.f, self.g = f, g.copy()
+
+        n_iter, n_eval = self.n_iter, self.n_eval
+        hits = self.cache['memo']['hits']
+        message = "Maximum number of iterations reached."
+        success = False
+
+        for i in range(max_iter):
+
+            if np.max(np.abs(self.g)) <= self.gtol:
+                message = "Gradient is less than gtol."
+                success = True
+                break
+
+            d = self.direction()
+            if np.dot(d, self.g) >= 0.0:
+                self.reset()
+                d = self.direction()
+
+            results = line_search(
+                lambda x: self.cost(x)[0],
+                lambda x: self.cost(x)[1],
+                self.x,
+                d,
+                gfk=self.g,
+                old_fval=self.f,
+                old_old_fval=self.f_previous
+            )
+            alpha = results[0]
+
+            if alpha is None:
+                if self.s:
+                    # Try again without the curvature information
+                    self.reset()
+                    continue
+                message = "Line search failed."
+                break
+
+            x = self.x + alpha*d
+            f, g = self.cost(x)
+
+            s = x - self.x
+            y = g - self.g
+            if np.dot(s, y) > 1e-10:
+                self.s.append(s)
+                self.y.append(y)
+
+            self.f_previous = self.f
+            self.x, self.f, self.g = x, f, g.copy()
+            self.n_iter += 1
+
+            if self.stopping is not None and \
+                    self.stopping.update(self.x, self.n_iter):
+                message = "Validation cost did not improve for %d " \
+                          "evaluations." % self.stopping.patience
+                break
+
+            if (self.f_previous - self.f) <= self.ftol*np.finfo(float).eps* \
+                    max(abs(self.f_previous), abs(self.f), 1.0):
+                message = "Relative reduction of cost is less than ftol."
+                success = True
+                break
+
+        if update:
+            if self.stopping is not None and self.stopping.stopped:
+                # self._net_weights is not updated so the next call
+                # starts again from the best weights
+                net.weights[:] = self.stopping.best_weights
+            else:
+                net.weights[:] = self.x
+                self._net_weights[:] = net.weights
+
+        # Transfer the normalization coefficients used in training to
+        # the network so they can be used later for prediction.
+        net.mu, net.sigma = self.training_data.mu, self.training_data.sigma
+
+        if messages:
+            print("Solver returned the following message:\n%s" % message)
+
+        return OptimizeResult(
+            x=self.x.copy(),
+            fun=self.f,
+            jac=self.g.copy(),
+            nit=self.n_iter - n_iter,
+            nfev=self.n_eval - n_eval,
+            memo_hits=self.cache['memo']['hits'] - hits,
+            success=success,
+            message=message
+        )
+
+
+class CostEvaluator(object):
+    """Object to calculate the cost function of a network on one
+    data set (e.g. validation data) repeatedly, for example to
+    monitor the training of the network.
+
+    The arrays needed are created once when the object is created
+    and the inputs are copied into them.  The gradients are not
+    calculated so the arrays needed for them are not created.
+
+    Example:
+    >>> test_cost = CostEvaluator(net, test_data)
+    >>> train(net, train_data, max_iter=100)
+    >>> test_cost()
+
+    Arguments:
+    net           -- MLPNetwork object.
+    data          -- MLPTrainingData object.
+
+    Keyword Arguments:
+    lambda_param  -- Regularization parameter included in the cost.
+                     Default is 0.0.
+    n_samples     -- (optional) if provided, the cost is calculated
+                     on a fixed, randomly-chosen sample of n_samples
+                     rows of data.
+    seed          -- (optional) seed for the random number generator
+                     used to choose the sample.
+
+    Attributes:
+    net, lambda_param -- as above.
+    data          -- the data used (an MLPTrainingSubset if
+                     n_samples was provided).
+    cache         -- the arrays used (see initialize_arrays).
+    """
+
+    def __init__(self, net, data, lambda_param=0.0, n_samples=None,
+                 seed=None):
+
+        if n_samples is not None and n_samples < len(data):
+            rng = np.random.RandomState(seed)
+            indices = np.sort(rng.choice(len(data), n_samples,
+                                         replace=False))
+            data = MLPTrainingSubset(data, indices, name=data.name)
+
+        self.net = net
+        self.data = data
+        self.lambda_param = lambda_param
+
+        self.cache = initialize_arrays(net, len(data), jac=False,
+                                       training_data=data)
+
+    def __call__(self, weights=None):
+        """Returns the cost function of the network with its
+        current weights or with the weights provided.
+        """
+
+        return self.net.cost_function(
+            self.net,
+            self.data,
+            weights=weights,
+            lambda_param=self.lambda_param,
+            jac=False,
+            cache=self.cache
+        )
+
+
+class EarlyStopping(object):
+    """Object to monitor the cost of a network on validation data
+    during training, keep a copy of the weights with the lowest
+    cost and decide when to stop training.  Used by train and
+    Trainer when validation_data is provided.
+
+    Arguments:
+    net             -- MLPNetwork object.
+    validation_data -- MLPTrainingData object.
+
+    Keyword Arguments:
+    eval_interval -- Number of iterations between evaluations of the
+                     validation cost.  Default is 1.
+    patience      -- (optional) number of evaluations without an
+                     improvement in the validation cost after which
+                     update returns True.  If None, update always
+                     returns False.
+    n_samples, seed -- (optional) evaluate the cost on a sample of
+                     the validation data (see CostEvaluator).
+
+    Attributes:
+    best_weights  -- the weights with the lowest validation cost
+                     (this array is created once and over-written).
+    best_cost     -- the lowest validation cost.
+    best_iter     -- the iteration number when the lowest cost
+                     occurred (None until the first evaluation).
+    costs         -- list of tuples (iteration, cost) of all the
+                     evaluations.
+    stopped       -- True if the last call to update returned True.
+    """
+
+    def __init__(self, net, validation_data, eval_interval=1,
+                 patience=None, n_samples=None, seed=None):
+
+        self.eval_interval = eval_interval
+        self.patience = patience
+        self.evaluate = CostEvaluator(net, validation_data,
+                                      n_samples=n_samples, seed=seed)
+
+        # The weights are copied into an array of the same data type
+        # as the network before evaluating the cost
+        self.weights = np.empty_like(net.weights)
+        self.best_weights = net.weights.copy()
+        self.best_cost = np.inf
+        self.best_iter = None
+        self.costs = []
+        self.n_iter = 0
+        self.n_bad = 0
+        self.stopped = False
+
+    def update(self, weights, n_iter=None):
+        """Call this after each iteration of the solver with the
+        current weights.  Returns True if the training should stop.
+
+        n_iter is the iteration number.  If not provided, the number
+        of calls to update is used.
+        """
+
+        self.n_iter = self.n_iter + 1 if n_iter is None else n_iter
+        self.stopped = False
+
+        if self.n_iter % self.eval_interval != 0:
+            return False
+
+        self.weights[:] = weights
+        cost = self.evaluate(self.weights)
+        self.costs.append((self.n_iter, cost))
+
+        if cost < self.best_cost:
+            self.best_cost = cost
+            self.best_iter = self.n_iter
+            self.best_weights[:] = self.weights
+            self.n_bad = 0
+        else:
+            self.n_bad += 1
+
+        if self.patience is not None and self.n_bad >= self.patience:
+            self.stopped = True
+            self.n_bad = 0
+
+        return self.stopped
+
+
+# Update rules for mini-batch (stochastic) training.  Each function
+# updates the weights in place using the gradients of the current
+# mini-batch.  Any arrays the update rule needs between steps are
+# created on the first call and kept in the state dictionary so that
+# no new arrays are allocated after the first update.
+
+def sgd_update(weights, grad, state, learning_rate=0.01):
+    """Plain stochastic gradient descent update:
+
+    weights = weights - learning_rate*grad
+    """
+
+    if not state:
+        state['tmp'] = np.empty_like(weights)
+
+    tmp = state['tmp']
+    np.multiply(grad, learning_rate, out=tmp)
+    weights -= tmp
+
+
+def momentum_update(weights, grad, state, learning_rate=0.01,
+                    momentum=0.9):
+    """Stochastic gradient descent with momentum:
+
+    v = momentum*v - learning_rate*grad
+    weights = weights + v
+    """
+
+    if not state:
+        state['v'] = np.zeros_like(weights)
+        state['tmp'] = np.empty_like(weights)
+
+    v, tmp = state['v'], state['tmp']
+    v *= momentum
+    np.multiply(grad, learning_rate, out=tmp)
+    v -= tmp
+    weights += v
+
+
+def adam_update(weights, grad, state, learning_rate=0.001, beta1=0.9,
+                beta2=0.999, epsilon=1.0e-8):
+    """Adam (adaptive moment estimation) update as described by
+    Kingma and Ba (2015).  The bias-corrections of the first and
+    second moment estimates are folded into the step size.
+    """
+
+    if not state:
+        state['t'] = 0
+        state['m'] = np.zeros_like(weights)
+        state['v'] = np.zeros_like(weights)
+        state['tmp'] = np.empty_like(weights)
+
+    state['t'] += 1
+    t, m, v, tmp = state['t'], state['m'], state['v'], state['tmp']
+
+    # First moment estimate
+    m *= beta1
+    np.multiply(grad, 1.0 - beta1, out=tmp)
+    m += tmp
+
+    # Second moment estimate
+    v *= beta2
+    np.multiply(grad, grad, out=tmp)
+    tmp *= 1.0 - beta2
+    v += tmp
+
+    step = learning_rate*np.sqrt(1.0 - beta2**t)/(1.0 - beta1**t)
+    np.sqrt(v, out=tmp)
+    tmp += epsilon
+    np.divide(m, tmp, out=tmp)
+    tmp *= step
+    weights -= tmp
+
+# This dictionary is used to reference the mini-batch update
+# rules by name
+
+optimizers = {
+    "sgd": sgd_update,
+    "momentum": momentum_update,
+    "adam": adam_update
+}
+
+
+def slice_arrays(arrays, m, start=0):
+    """Returns a dictionary of views of m rows (starting at row
+    start) of the arrays created by initialize_arrays.  The
+    gradient arrays are shared with the original dictionary.
+    """
+
+    def rows(items):
+        if items is None:
+            return None
+        return [None if x is None else x[start:start + m] for x in items]
+
+    A = rows(arrays['A'])
+    Z = rows(arrays['Z'])
+
+    # For linear layers A[j] and Z[j] are the same array
+    for j, (a, z) in enumerate(zip(arrays['A'], arrays['Z'])):
+        if a is z:
+            A[j] = Z[j]
+
+    return {
+        'A': A,
+        'Z': Z,
+        'sigma': rows(arrays['sigma']),
+        'grad': arrays['grad'],
+        'theta_grad': arrays['theta_grad'],
+        'bias_grad': arrays['bias_grad'],
+        'D': rows(arrays['D']),
+        'work': rows(arrays.get('work'))
+    }
+
+
+def train_minibatch(net, training_data, batch_size=32, n_epochs=1,
+                    method='adam', options=None, update=True, disp=False,
+                    lambda_param=0.0, shuffle=True, seed=None, lean=False):
+    """Trains a network (net) on a set of training data using
+    mini-batch stochastic gradient descent.  Unlike train, which
+    evaluates the cost function on all the training data at each
+    iteration of the solver, the weights are updated after every
+    mini-batch so there are many updates per pass through the
+    data (epoch).
+
+    One set of arrays (see initialize_arrays) sized to the batch
+    is used for all the mini-batches so memory use is determined by
+    batch_size, not by the size of the training data set.  The
+    training data may therefore be a data set opened from a file
+    with MLPTrainingData.from_file that is too large to fit in
+    memory (use shuffle=False to read the file sequentially).
+
+    Returns a scipy.optimize.OptimizeResult object with the
+    attributes x (the final weights), fun (average cost during the
+    last epoch), costs (average cost during each epoch), nit (number
+    of weight updates) and nepochs.
+
+    Arguments:
+    net           -- MLPNetwork object.
+    training_data -- MLPTrainingData object.
+
+    Keyword Arguments:
+    batch_size   -- Number of training examples in each mini-batch.
+                    Default is 32.
+    n_epochs     -- Number of passes through the training data.
+    method       -- Select the update rule to use from the optimizers
+                    dictionary ('sgd', 'momentum' or 'adam').
+                    Default is 'adam'.
+    options      -- (optional) dictionary of keyword arguments for
+                    the update rule (e.g. {'learning_rate': 0.01}).
+    update       -- Set to False if you don't want to update the
+                    network's weights at the end of the training.
+                    Default is True.
+    disp         -- Set to True to print the average cost after
+                    each epoch.
+    lambda_param -- Regularization parameter.  This is scaled for
+                    each mini-batch so that the regularization is
+                    the same as when training with train.
+                    Default is 0.0.
+    shuffle      -- If True (default), the training examples are
+                    visited in a new random order each epoch.
+    seed         -- (optional) seed for the random number generator
+                    used to shuffle the training data.
+    lean         -- If True, the arrays for a mini-batch use less
+                    memory (see initialize_arrays) so larger batches
+                    fit in the processor's caches.  The results are
+                    the same.
+    """
+
+    if method not in optimizers:
+        raise ValueError("Invalid value for keyword argument 'method'")
+    update_rule = partial(optimizers[method], **(options or {}))
+
+    # Number of training examples
+    m = len(training_data)
+
+    batch_size = min(batch_size, m)
+
+    # Prepare arrays (empty) for one mini-batch.  The inputs of each
+    # mini-batch are copied straight into A[0].
+    arrays = initialize_arrays(net, batch_size, lean=lean)
+    arrays['A'][0][:] = 0.0
+    batch = MLPTrainingData(
+        inputs=arrays['A'][0],
+        outputs=np.zeros((batch_size, training_data.n_out),
+                         dtype=net.dtype),
+        dtype=net.dtype,
+        name="Mini-batch"
+    )
+
+    # If the data does not divide into equal mini-batches, the last
+    # one uses views of the first rows of the same arrays
+    remainder = m % batch_size
+    if remainder > 0:
+        last_arrays = slice_arrays(arrays, remainder)
+        last_batch = MLPTrainingData(
+            inputs=last_arrays['A'][0],
+            outputs=batch.outputs[:remainder],
+            dtype=net.dtype,
+            name="Mini-batch"
+        )
+
+    rng = np.random.RandomState(seed)
+    weights = net.weights.copy()
+    state = {}
+    costs = []
+    n_updates = 0
+
+    for epoch in range(n_epochs):
+
+        if shuffle:
+            order = rng.permutation(m)
+
+        total_cost = 0.0
+        for start in range(0, m, batch_size):
+            finish = min(start + batch_size, m)
+
+            if finish - start == batch_size:
+                cache, data = arrays, batch
+            else:
+                cache, data = last_arrays, last_batch
+
+            if shuffle:
+                idx = order[start:finish]
+            else:
+                idx = slice(start, finish)
+            training_data.take(idx, inputs=data.inputs,
+                               outputs=data.outputs)
+
+            # Scale the regularization term so that the sum of the
+            # mini-batch costs is equivalent to the full-batch cost
+            J, grad = net.cost_function(
+                net,
+                data,
+                weights=weights,
+                lambda_param=lambda_param*(finish - start)/m,
+                jac=True,
+                cache=cache
+            )
+
+            update_rule(weights, grad, state)
+            n_updates += 1
+            total_cost += J*(finish - start)
+
+        costs.append(total_cost/m)
+
+        if disp:
+            print("Epoch %d: average cost %g" % (epoch + 1, costs[-1]))
+
+    if update:
+        net.weights[:] = weights
+
+    # Transfer the normalization coefficients used in training to the
+    # network so they can be used later for prediction.
+    net.mu, net.sigma = training_data.mu, training_data.sigma
+
+    return OptimizeResult(
+        x=weights,
+        fun=costs[-1] if costs else None,
+        costs=np.array(costs),
+        nit=n_updates,
+        nepochs=n_epochs,
+        success=True,
+        message="Completed %d epochs (%d updates)." % (n_epochs, n_updates)
+    )
+
+
+def sigmoid_cross_entropy(z, y, out=None, work=None):
+    """Returns the binary cross-entropy (negative log-likelihood)
+    of the outputs sigmoid(z) of a network for the desired outputs
+    y element by element, calculated from the pre-activations z as
+    log(1 + exp(z)) - y*z with np.logaddexp.  Unlike
+    -y*log(a) - (1 - y)*log(1 - a), this is never inf or nan when
+    the outputs a are rounded to 0.0 or 1.0.
+
+    If arrays are provided for out and work (the same shape as z),
+    the results are written to out and work is used for the
+    intermediate results so no new arrays are created.
+    """
+
+    # log(1 + exp(z)) underflows harmlessly to 0.0 for large
+    # negative z
+    with np.errstate(under='ignore'):
+        out = np.logaddexp(0.0, z, out=out)
+    out -= np.multiply(y, z, out=work)
+
+    return out
+
+
+def cost_function_log(net, training_data, weights=None,
+                      lambda_param=0.0, jac=True, cache=None):
+    """Computes the cost function (J) and gradients (grad) of the
+    network on the training_data with the logistic cost function*
+    using back-propagation.
+
+    *Note: This is also known as the Bernoulli negative log-
+    likelihood and binary cross-entropy. It should only be used for
+    problems such as classification where y values are either 0.0
+    or 1.0.
+
+    The cost is calculated from the pre-activations of the output
+    layer (see sigmoid_cross_entropy) so it is finite even when the
+    outputs of the network are rounded to 0.0 or 1.0.
+
+    Arguments:
+    net           -- A neural network model (MLPNetwork).
+    training_data -- A set of training data (MLPTrainingData).
+
+    Keyword arguments:
+    weights       -- Provide a new set of weights to calculate the
+                     cost function (current network weights will not
+                     be affected).  If not specified, the cost
+                     function will use the current weights stored in
+                     the network.
+    lambda_param  -- Regularization term.  If not specified then
+                     default is lambda_param=0.0 (i.e. no
+                     regularization).
+    jac           -- If set to None or False then this function does
+                     not calculate or return the Jacobian matrix (of
+                     gradients).
+    cache         -- (optional) provide a set of existing arrays
+                     to avoid re-initializaing arryas each time this
+                     cost function is calculated. If cache is None,
+                     new (empty) arrays will be initialized.  If the
+                     cache was created with memoize=True and the
+                     last evaluation with this cache used the same
+                     weights, the last result is returned (see
+                     initialize_memo).
+
+    Returns:
+    (J, grad)     -- Cost and gradients matrix.
+    """
+
+    # Desired outputs from training data (the inputs are in A[0])
+    Y = training_data.outputs
+
+    # Number of examples in training data set
+    m = Y.shape[0]
+
+    if cache is None:
+        # initialize all arrays as new (empty) arrays (or one set of
+        # arrays for a chunk of rows if the data set is large)
+        cache = initialize_training_arrays(net, training_data)
+
+    # Process large data sets in chunks of rows
+    if 'chunk' in cache:
+        return chunked_cost_function(net, training_data, weights=weights,
+                                     lambda_param=lambda_param, jac=jac,
+                                     cache=cache)
+
+    # Return the last result if the weights have not changed
+    result = memo_lookup(cache, net.weights if weights is None
+                         else weights, lambda_param, jac)
+    if result is not None:
+        return result
+
+    A = cache['A']
+    Z = cache['Z']
+    sigma =  cache['sigma']
+    grad = cache['grad']
+    theta_grad = cache['theta_grad']
+    bias_grad = cache['bias_grad']
+    D = cache.get('D')
+
+    # Get the weights of each layer as a list of 2-dimensional arrays
+    # and the bias terms as a list of one-dimensional arrays, either
+    # from the network or from the set of weights provided.
+    theta, bias = net.get_layer_params(weights=weights)
+
+    # Calculate A and Z (and the derivatives of the activation
+    # functions, D)
+    feed_forward(net, A, Z, theta, bias, D)
+
+    assert net.layers[-1].act_func is activation_functions["sigmoid"]
+
+    # Cost function
+    # Negative log-likelihood of the Bernoulli distribution
+    # (vectorized) calculated from the pre-activations of the
+    # output layer (see sigmoid_cross_entropy).  The results are
+    # finite even when the outputs are exactly 0.0 or 1.0.
+    # The derivatives of the output layer (D[-1]) are not needed
+    # with this cost function so D[-1] and sigma[-1] (which is
+    # over-written below) are used to hold the terms.
+    if jac:
+        losses = sigmoid_cross_entropy(
+            Z[-1], Y,
+            out=None if D is None else D[-1],
+            work=sigma[-1]
+        )
+    else:
+        work = cache.get('work') or (None, None)
+        losses = sigmoid_cross_entropy(Z[-1], Y, out=work[0],
+                                       work=work[1])
+    J = np.sum(losses)/m
+
+    # Add regularization terms
+    if lambda_param != 0.0:
+
+        for j, layer in enumerate(net.layers[1:], start=1):
+            J = J + lambda_param*np.vdot(theta[j], theta[j])/(2.0*m)
+
+    # If jac is set to None or False then don't calculate
+    # the gradient and end here
+    if not jac:
+        memo_store(cache, net.weights if weights is None else weights,
+                   lambda_param, J, jac)
+        return J
+
+    # Otherwise, gradients will be calculated and
+    # added to the array grad which has the same
+    # dimensions as weights
+    # grad = np.zeros(self.n_weights, dtype=net.dtype)
+
+    # sigma, theta_grad and bias_grad arrays will be calculated
+    # for each layer.
+
+    # Calculate dJ/dZ (sigma) for the output layer
+    # TODO: Change sigma to dZ for consistency with A Ng course
+    # For negative log-likelihood cost function and with
+    # the sigmoid function in the output layer, sigma is
+    # simply A - Y:
+    np.subtract(A[-1], Y, out=sigma[-1])
+
+    # Back-propagate to calculate derivatives
+    back_prop(net, sigma, A, Z, theta, theta_grad, bias_grad,
+              lambda_param, D)
+
+    memo_store(cache, net.weights if weights is None else weights,
+               lambda_param, J, jac)
+
+    return (J, grad)
+
+
+def cost_function_mse(net, training_data, weights=None,
                       lambda_param=0.0, jac=True, cache=None):
     """Computes the cost function (J) and gradients (grad) of the
-    network on the training_data with the logistic cost function*
-    using back-propagation.
+    network on the training_data with the mean-squared-error cost
+    function* using back-propagation.
+
+    *Note: This cost function is also known as the maximum likelihood
+    or sum-squared error method. It is generally useful for
+    regression and function approximation problems.
+
+    Arguments:
+    net           -- A neural network model (MLPNetwork).
+    training_data -- A set of training data (MLPTrainingData).
+
+    Keyword arguments:
+    weights       -- Provide a new set of weights to calculate the
+                     cost function (current network weights will not
+                     be affected).  If not specified, the cost
+                     function will use the current weights stored in
+                     the network.
+    lambda_param  -- Regularization term.  If not specified then
+                     default is lambda_param=0.0 (i.e. no
+                     regularization).
+    jac           -- If set to None or False then this function does
+                     not calculate or return the Jacobian matrix (of
+                     gradients).
+    cache         -- (optional) provide a set of existing arrays
+                     to avoid re-initializaing arryas each time this
+                     cost function is calculated. If cache is None,
+                     new (empty) arrays will be initialized.  If the
+                     cache was created with memoize=True and the
+                     last evaluation with this cache used the same
+                     weights, the last result is returned (see
+                     initialize_memo).
+
+    Returns:
+    (J, grad)     -- Cost and gradients matrix.
+    """
+
+    # Desired outputs from training data (the inputs are in A[0])
+    Y = training_data.outputs
+
+    # Number of examples in training data set
+    m = Y.shape[0]
+
+    if cache is None:
+        # initialize all arrays as new (empty) arrays (or one set of
+        # arrays for a chunk of rows if the data set is large)
+        cache = initialize_training_arrays(net, training_data)
+
+    # Process large data sets in chunks of rows
+    if 'chunk' in cache:
+        return chunked_cost_function(net, training_data, weights=weights,
+                                     lambda_param=lambda_param, jac=jac,
+                                     cache=cache)
+
+    # Return the last result if the weights have not changed
+    result = memo_lookup(cache, net.weights if weights is None
+                         else weights, lambda_param, jac)
+    if result is not None:
+        return result
+
+    A = cache['A']
+    Z = cache['Z']
+    sigma =  cache['sigma']
+    grad = cache['grad']
+    theta_grad = cache['theta_grad']
+    bias_grad = cache['bias_grad']
+    D = cache.get('D')
+
+    # Get the weights of each layer as a list of 2-dimensional arrays
+    # and the bias terms as a list of one-dimensional arrays, either
+    # from the network or from the set of weights provided.
+    theta, bias = net.get_layer_params(weights=weights)
+
+    # Calculate A and Z (and the derivatives of the activation
+    # functions, D)
+    feed_forward(net, A, Z, theta, bias, D)
+
+    # Errors of the outputs.  When the gradients are calculated,
+    # they are written to sigma[-1] (where they are needed to
+    # calculate dJ/dZ of the output layer) so that no temporary
+    # arrays are created.
+    if jac:
+        errors = np.subtract(A[-1], Y, out=sigma[-1])
+    else:
+        work = cache.get('work') or (None, )
+        errors = np.subtract(A[-1], Y, out=work[0])
+
+    # Regular mean-squared-error (MSE) cost function
+    J = 0.5*np.vdot(errors, errors)/m
+
+    # Add regularization terms
+    if lambda_param != 0.0:
+
+        for j, layer in enumerate(net.layers[1:], start=1):
+            J = J + lambda_param*np.vdot(theta[j], theta[j])/(2.0*m)
+
+    # If jac is set to None or False then don't calculate
+    # the gradient and end here
+    if not jac:
+        memo_store(cache, net.weights if weights is None else weights,
+                   lambda_param, J, jac)
+        return J
+
+    # Otherwise, gradients will be calculated and
+    # added to the array grad which has the same
+    # dimensions as weights
+    # grad = np.zeros(self.n_weights, dtype=net.dtype)
+
+    # sigma, theta_grad and bias_grad arrays will be calculated
+    # for each layer.
+
+    # Calculate dJ/dZ (sigma) for the output layer from the errors
+    # already in sigma[-1]:
+    # TODO: Change sigma to dZ for consistency with A Ng course
+    multiply_derivatives(net.layers[-1], sigma[-1], Z[-1], A[-1],
+                         None if D is None else D[-1])
+
+    # Back-propagate to calculate derivatives
+    back_prop(net, sigma, A, Z, theta, theta_grad, bias_grad,
+              lambda_param, D)
+
+    memo_store(cache, net.weights if weights is None else weights,
+               lambda_param, J, jac)
+
+    return (J, grad)
+
+
+def add_regularization(net, J, theta, theta_grad, lambda_param, m):
+    """Adds the regularization terms to the cost function J and
+    (if theta_grad is not None) to the gradients theta_grad of the
+    weights of each layer.  Used to regularize the total of the
+    results of all the shards once.  Returns J.
+    """
+
+    if lambda_param == 0.0:
+        return J
+
+    for j in range(1, net.n_layers):
+        J += lambda_param*np.vdot(theta[j], theta[j])/(2.0*m)
+        if theta_grad is not None:
+            add_scaled(theta_grad[j], lambda_param/m, theta[j])
+
+    return J
+
+
+def chunked_cost_function(net, training_data, weights=None,
+                          lambda_param=0.0, jac=True, cache=None):
+    """Computes the cost function (J) and gradients (grad) of the
+    network on the training_data by applying net.cost_function to
+    chunks of rows of the data one at a time and adding up the
+    results.  The results are the same as with all the rows at once
+    but the memory needed depends only on the chunk size.  The cost
+    functions call this function when their cache was created by
+    initialize_chunked_arrays.
+
+    Arguments:
+    net           -- A neural network model (MLPNetwork).
+    training_data -- A set of training data (MLPTrainingData).  This
+                     may contain memory-mapped arrays.
+
+    Keyword arguments:
+    weights       -- Weights to use instead of the network's weights.
+    lambda_param  -- Regularization term.  Default is 0.0.
+    jac           -- If set to None or False then only the cost
+                     function is returned.
+    cache         -- Arrays created by initialize_chunked_arrays.
+                     If None, they are created with the default
+                     memory budget.
+
+    Returns:
+    (J, grad)     -- Cost and gradients matrix.
+    """
+
+    m = len(training_data)
+
+    if cache is None:
+        cache = initialize_chunked_arrays(net, m, jac=jac)
+
+    # Return the last result if the weights have not changed
+    result = memo_lookup(cache, net.weights if weights is None
+                         else weights, lambda_param, jac)
+    if result is not None:
+        return result
+
+    theta, bias = net.get_layer_params(weights=weights)
+
+    chunk = cache['chunk']
+    chunk_size = cache['chunk_size']
+    grad = cache['grad']
+    inputs_buffer = chunk['A'][0]
+
+    J = 0.0
+    for start in range(0, m, chunk_size):
+        finish = min(start + chunk_size, m)
+        n = finish - start
+        data = MLPTrainingSubset(training_data, slice(start, finish))
+
+        arrays = chunk if n == chunk_size else slice_arrays(chunk, n)
+        arrays = dict(arrays, A=list(arrays['A']), memo=None)
+
+        # The cost functions read the inputs from A[0]
+        inputs = data.inputs
+        if inputs.dtype == inputs_buffer.dtype:
+            arrays['A'][0] = inputs
+        else:
+            arrays['A'][0] = inputs_buffer[:n]
+            arrays['A'][0][:] = inputs
+
+        result = net.cost_function(
+            net,
+            data,
+            weights=weights,
+            lambda_param=0.0,
+            jac=jac,
+            cache=arrays
+        )
+
+        # Weighted sum of the results of the chunks
+        w = n/m
+        if jac:
+            J += w*result[0]
+            chunk_grad = result[1]
+            chunk_grad *= w
+            if start == 0:
+                grad[:] = chunk_grad
+            else:
+                grad += chunk_grad
+        else:
+            J += w*result
+
+    J = add_regularization(net, J, theta,
+                           cache['theta_grad'] if jac else None,
+                           lambda_param, m)
+
+    memo_store(cache, net.weights if weights is None else weights,
+               lambda_param, J, jac)
+
+    if jac:
+        return (J, grad)
+    return J
+
+
+# ------------------ PARALLEL COST FUNCTIONS ----------------------
+
+# Objects that calculate the cost function and gradients of a
+# network on a large set of training data by dividing the rows of
+# the data into shards and evaluating the shards in parallel.
+# They return (J, grad) for a one-dimensional array of weights
+# and can be used with train (see the objective argument).
+
+
+def shard_bounds(m, n_shards):
+    """Returns a list of tuples (start, finish) dividing m rows
+    into n_shards blocks of consecutive rows of (nearly) equal
+    size.
+    """
+
+    edges = np.linspace(0, m, n_shards + 1).astype(int)
+
+    return [(int(start), int(finish)) for start, finish in
+            zip(edges[:-1], edges[1:]) if finish > start]
+
+
+class ThreadedCostFunction(object):
+    """Calculates the cost function and gradients of a network on
+    a set of training data using a pool of threads.  The rows of
+    the training data are divided into one shard per thread.  Each
+    shard uses its own rows of one set of arrays created by
+    initialize_arrays (see slice_arrays) and its own gradients
+    array.  The gradients of the shards are added together at the
+    end.
+
+    numpy releases the global interpreter lock (GIL) during matrix
+    multiplications and element-wise operations on arrays so the
+    activation functions are calculated on all the threads at the
+    same time, not only the BLAS calls.  If the BLAS library also
+    uses several threads, it may be better to limit it to one
+    thread per shard (e.g. with the threadpoolctl package).
+
+    Arguments:
+    net           -- MLPNetwork object.
+    training_data -- MLPTrainingData object.
+
+    Keyword arguments:
+    lambda_param -- Regularization parameter.  Default is 0.0.
+    n_threads    -- Number of threads (and shards).  If not
+                    specified, the number of processors is used.
+    memoize      -- If True (default), the last result is returned
+                    again if the weights have not changed (see
+                    initialize_memo).
+
+    Attributes:
+    shards  -- list of tuples (start, finish, data, cache) for each
+               shard where data is an MLPTrainingSubset and cache
+               is the dictionary of arrays used by the shard.
+    grad    -- array of the total gradients (over-written by each
+               evaluation).
+    cache   -- dictionary containing grad and memo.
+
+    Example:
+    >>> objective = ThreadedCostFunction(net, training_data, n_threads=4)
+    >>> res = train(net, training_data, max_iter=100, objective=objective)
+    >>> objective.close()
+    """
+
+    def __init__(self, net, training_data, lambda_param=0.0,
+                 n_threads=None, memoize=True):
+
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+
+        self.net = net
+        self.training_data = training_data
+        self.lambda_param = lambda_param
+
+        m = len(training_data)
+        self.m = m
+
+        # One set of arrays for all the data.  Each shard uses a
+        # block of rows of these arrays.
+        self.arrays = initialize_arrays(net, m, training_data=training_data)
+
+        self.shards = []
+        for start, finish in shard_bounds(m, n_threads):
+            data = MLPTrainingSubset(training_data, slice(start, finish))
+            cache = slice_arrays(self.arrays, finish - start, start)
+
+            # Each shard has its own gradients array
+            cache['grad'] = np.zeros(net.n_weights, dtype=net.dtype)
+            cache['theta_grad'], cache['bias_grad'] = \
+                weight_views(net, cache['grad'])
+            self.shards.append((start, finish, data, cache))
+
+        self.grad = np.zeros(net.n_weights, dtype=net.dtype)
+        self.theta_grad, self.bias_grad = weight_views(net, self.grad)
+        self.cache = {
+            'grad': self.grad,
+            'memo': initialize_memo(net) if memoize else None
+        }
+
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def shard_cost(self, shard, weights, jac):
+        """Returns the cost function (and gradients if jac is True)
+        of one shard without regularization.
+        """
+
+        start, finish, data, cache = shard
+
+        return self.net.cost_function(
+            self.net,
+            data,
+            weights=weights,
+            lambda_param=0.0,
+            jac=jac,
+            cache=cache
+        )
+
+    def __call__(self, weights=None, jac=True):
+        """Returns (J, grad) for the weights provided (or the
+        network's weights), or J if jac is False.  Note: grad is
+        over-written by the next evaluation.
+        """
+
+        net = self.net
+        if weights is None:
+            weights = net.weights
+
+        result = memo_lookup(self.cache, weights, self.lambda_param, jac)
+        if result is not None:
+            return result
+
+        # Create the views of the weights of each layer here so
+        # that the threads find them in the network's theta_cache
+        theta, bias = net.get_layer_params(weights=weights)
+
+        results = list(self.executor.map(
+            lambda shard: self.shard_cost(shard, weights, jac),
+            self.shards
+        ))
+
+        # Weighted sum of the results of the shards
+        J = 0.0
+        for (start, finish, data, cache), result in zip(self.shards,
+                                                        results):
+            w = (finish - start)/self.m
+            if jac:
+                J += w*result[0]
+                shard_grad = result[1]
+                shard_grad *= w
+                if start == 0:
+                    self.grad[:] = shard_grad
+                else:
+                    self.grad += shard_grad
+            else:
+                J += w*result
+
+        # Add regularization terms
+        J = add_regularization(net, J, theta,
+                               self.theta_grad if jac else None,
+                               self.lambda_param, self.m)
+
+        memo_store(self.cache, weights, self.lambda_param, J, jac)
+
+        if jac:
+            return (J, self.grad)
+        return J
+
+    def close(self):
+        """Shut down the pool of threads."""
+
+        self.executor.shutdown()
+
+
+def create_shared_array(shape, dtype):
+    """Returns a tuple (shm, array) of a new
+    multiprocessing.shared_memory.SharedMemory block and a numpy
+    array of the given shape and data type using its memory.
+    """
+
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape))*dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def attach_shared_array(name, shape, dtype):
+    """Returns a tuple (shm, array) of an existing shared memory
+    block (see create_shared_array) and a numpy array using its
+    memory.
+    """
+
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def process_cost_worker(conn, spec, arrays, index, start, finish):
+    """Worker process used by ProcessCostFunction.  Attaches to the
+    shared arrays, then waits for commands from conn.  For each
+    command ('cost', jac) it calculates the cost
+    function (and gradients) of rows start to finish of the
+    training data with the weights in the shared weights array and
+    writes the results to row index of the shared costs and
+    gradients arrays.  The command ('stop', ) ends the process.
+
+    Only the short commands and replies are sent through conn.  The
+    data, weights and results are exchanged through shared memory.
+    """
+
+    ndim, act_funcs, cost_function, dtype = spec
+
+    # The unpickled (function, gradient) tuples are new objects.  Use
+    # the tuples in activation_functions instead because some code
+    # identifies activation functions by identity (e.g.
+    # cost_function_log).
+    registered = list(activation_functions.values())
+    act_funcs = [next((f for f in registered if f == item), item)
+                 for item in act_funcs]
+
+    net = MLPNetwork(list(ndim), act_funcs=act_funcs, dtype=dtype)
+    net.cost_function = cost_function
+
+    blocks = {}
+    for key, (name, shape) in arrays.items():
+        blocks[key] = attach_shared_array(name, shape, dtype)
+
+    inputs = blocks['inputs'][1][start:finish]
+    outputs = blocks['outputs'][1][start:finish]
+    weights = blocks['weights'][1]
+    costs = blocks['costs'][1]
+    grad = blocks['grads'][1][index]
+
+    data = MLPTrainingData(inputs=inputs, outputs=outputs, dtype=dtype,
+                           check_nan=False)
+
+    # The gradients are written directly to the shared array
+    cache = initialize_arrays(net, finish - start, training_data=data)
+    cache['grad'] = grad
+    cache['theta_grad'], cache['bias_grad'] = weight_views(net, grad)
+
+    try:
+        while True:
+            command = conn.recv()
+            if command[0] == 'stop':
+                break
+
+            jac = command[1]
+            try:
+                result = net.cost_function(
+                    net,
+                    data,
+                    weights=weights,
+                    lambda_param=0.0,
+                    jac=jac,
+                    cache=cache
+                )
+                costs[index] = result[0] if jac else result
+                conn.send(('ok', ))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    finally:
+        # Remove references to the shared memory before closing it
+        del inputs, outputs, weights, costs, grad, data, cache
+        for shm, array in blocks.values():
+            del array
+        blocks.clear()
+        conn.close()
+
+
+class ProcessCostFunction(object):
+    """Calculates the cost function and gradients of a network on
+    a set of training data using a number of worker processes.
+    The rows of the training data are divided into one shard per
+    worker.
+
+    The training data are copied once into shared memory blocks
+    (multiprocessing.shared_memory) which all the workers attach
+    to.  For each evaluation, the weights are copied into another
+    shared block and each worker writes its cost and gradients to
+    shared arrays which are added together by this process.  Only
+    short commands are sent to the workers so no weights or data
+    are pickled for each evaluation.  Unlike ThreadedCostFunction,
+    the python code of the feed-forward and back-propagation
+    computations runs in parallel too.
+
+    The object should be closed when it is no longer needed to stop
+    the workers and release the shared memory, either by calling
+    close or by using it in a with statement.
+
+    The workers are started with the 'spawn' method by default so
+    the script using this object must protect its main code with
+    if __name__ == '__main__':.  The activation functions and cost
+    function of the network must be defined at module level (so
+    that they can be pickled).
+
+    Arguments:
+    net           -- MLPNetwork object.
+    training_data -- MLPTrainingData object.
+
+    Keyword arguments:
+    lambda_param -- Regularization parameter.  Default is 0.0.
+    n_workers    -- Number of worker processes (and shards).  If not
+                    specified, the number of processors is used.
+    blas_threads_per_worker -- Number of BLAS threads used by each
+                    worker (see blas_threads).  Default is 1.
+    memoize      -- If True (default), the last result is returned
+                    again if the weights have not changed (see
+                    initialize_memo).
+    start_method -- multiprocessing start method.  Default is
+                    'spawn'.
+
+    Example:
+    >>> with ProcessCostFunction(net, training_data,
+    ...                          n_workers=8) as objective:
+    ...     res = train(net, training_data, max_iter=100,
+    ...                 objective=objective)
+    """
+
+    def __init__(self, net, training_data, lambda_param=0.0,
+                 n_workers=None, blas_threads_per_worker=1, memoize=True,
+                 start_method='spawn'):
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+
+        self.net = net
+        self.lambda_param = lambda_param
+        dtype = net.dtype
+
+        m = len(training_data)
+        self.m = m
+        bounds = shard_bounds(m, n_workers)
+
+        # Shared arrays
+        self.blocks = {}
+        self.connections = []
+        self.workers = []
+        shapes = {
+            'inputs': (m, net.n_inputs),
+            'outputs': (m, net.n_outputs),
+            'weights': (net.n_weights, ),
+            'costs': (len(bounds), ),
+            'grads': (len(bounds), net.n_weights)
+        }
+
+        # If anything fails from here on, the shared memory blocks
+        # and workers created so far are released before the error
+        # is raised.
+        try:
+            for key, shape in shapes.items():
+                self.blocks[key] = create_shared_array(shape, dtype)
+
+            # Copy the training data to shared memory (in chunks)
+            inputs = self.blocks['inputs'][1]
+            outputs = self.blocks['outputs'][1]
+            for x, y, start, finish in training_data.iter_chunks():
+                inputs[start:finish] = x
+                outputs[start:finish] = y
+
+            self.weights = self.blocks['weights'][1]
+            self.costs = self.blocks['costs'][1]
+            self.grads = self.blocks['grads'][1]
+
+            # Weight of each shard in the total
+            self.shard_weights = np.array(
+                [(finish - start)/m for start, finish in bounds],
+                dtype=dtype
+            )
+
+            self.grad = np.zeros(net.n_weights, dtype=dtype)
+            self.theta_grad, self.bias_grad = weight_views(net, self.grad)
+            self.cache = {
+                'grad': self.grad,
+                'memo': initialize_memo(net) if memoize else None
+            }
+
+            spec = (net.dimensions, net.get_act_funcs(), net.cost_function,
+                    dtype)
+            arrays = {key: (shm.name, shapes[key])
+                      for key, (shm, array) in self.blocks.items()}
+
+            context = multiprocessing.get_context(start_method)
+            with blas_threads(blas_threads_per_worker):
+                for index, (start, finish) in enumerate(bounds):
+                    conn, worker_conn = context.Pipe()
+                    worker = context.Process(
+                        target=process_cost_worker,
+                        args=(worker_conn, spec, arrays, index, start, finish),
+                        daemon=True
+                    )
+                    worker.start()
+                    worker_conn.close()
+                    self.connections.append(conn)
+                    self.workers.append(worker)
+        except BaseException:
+            self.close()
+            raise
+
+    def __call__(self, weights=None, jac=True):
+        """Returns (J, grad) for the weights provided (or the
+        network's weights), or J if jac is False.  Note: grad is
+        over-written by the next evaluation.
+        """
+
+        net = self.net
+        if weights is None:
+            weights = net.weights
+
+        result = memo_lookup(self.cache, weights, self.lambda_param, jac)
+        if result is not None:
+            return result
+
+        self.weights[:] = weights
+
+        for conn in self.connections:
+            conn.send(('cost', jac))
+
+        errors = []
+        for conn in self.connections:
+            reply = conn.recv()
+            if reply[0] == 'error':
+                errors.append(reply[1])
+        if errors:
+            raise MLPError("Error in cost function worker process:\n" +
+                           errors[0])
+
+        # Weighted sum of the results of the shards
+        J = float(np.dot(self.shard_weights, self.costs))
+        if jac:
+            np.dot(self.shard_weights, self.grads, out=self.grad)
+
+        theta = net.get_theta(weights=self.weights)
+        J = add_regularization(net, J, theta,
+                               self.theta_grad if jac else None,
+                               self.lambda_param, self.m)
+
+        memo_store(self.cache, weights, self.lambda_param, J, jac)
+
+        if jac:
+            return (J, self.grad)
+        return J
+
+    def close(self):
+        """Stop the worker processes and release the shared
+        memory.  Can be called more than once, and on an object
+        whose __init__ failed part of the way through.
+        """
+
+        for conn in getattr(self, 'connections', []):
+            try:
+                conn.send(('stop', ))
+            except (OSError, EOFError):
+                pass
+            conn.close()
+        for worker in getattr(self, 'workers', []):
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+        self.weights = self.costs = self.grads = None
+        blocks = getattr(self, 'blocks', {})
+        for key in list(blocks):
+            shm, array = blocks.pop(key)
+            del array
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# ------------------ STACKED NETWORKS ----------------------
+
+# A stack of networks is a number of networks with the same
+# dimensions, activation functions and cost function which are
+# trained at the same time (e.g. to train an ensemble or to try
+# different random initial weights).  The weights of all the
+# networks are stored in one 2-dimensional array and the
+# computations for all networks are done together using np.matmul
+# on 3-dimensional arrays.  This makes much better use of the
+# processor than training each small network separately.
+
+
+class MLPNetworkStack(object):
+    """Stack of k multi-layer perceptron neural networks with the
+    same dimensions, activation functions and cost function.
+
+    Arguments:
+    net -- MLPNetwork object used as a template for the networks.
+    k   -- number of networks in the stack.
+
+    Attributes:
+    net        -- the template network.
+    k          -- number of networks in the stack.
+    n_weights  -- number of weights in each network.
+    weights    -- 2-dimensional numpy array (k, n_weights) of the
+                  weights of all the networks.  Row i contains the
+                  weights of network i in the same order as
+                  MLPNetwork.weights.
+    theta      -- list of 3-dimensional arrays (views of weights)
+                  containing the weights of each layer of all the
+                  networks.
+    bias       -- list of 2-dimensional arrays (views of weights)
+                  containing the bias terms of each layer of all the
+                  networks.
+    mu, sigma  -- Normalization coefficients (see MLPNetwork).
+
+    Methods:
+    get_theta          -- returns the weights of each layer as
+                          3-dimensional arrays.
+    get_layer_params   -- returns the weights and bias terms of each
+                          layer as separate arrays.
+    initialize_weights -- initialize the weights of all networks
+                          with random numbers.
+    predict            -- makes predictions with all the networks.
+    get_network        -- returns a copy of one of the networks as an
+                          MLPNetwork.
+    """
+
+    def __init__(self, net, k):
+
+        self.net = net
+        self.k = k
+        self.n_weights = net.n_weights
+        self.dtype = net.dtype
+        self.mu = net.mu
+        self.sigma = net.sigma
+        self.weights = np.zeros((k, self.n_weights), dtype=self.dtype)
+        self.weights[:] = net.weights
+        self.theta, self.bias = weight_views(net, self.weights)
+
+    def get_theta(self, weights=None):
+        """Returns the weights of each layer as a list of
+        3-dimensional arrays of shape (k, n_nodes, n_inputs).
+        Note: these are not copies of the weights.
+        """
+
+        return self.get_layer_params(weights=weights)[0]
+
+    def get_layer_params(self, weights=None):
+        """Returns a tuple (theta, bias) of two lists containing the
+        3-dimensional arrays (k, n_nodes, n_inputs) of weights and
+        the 2-dimensional arrays (k, n_nodes) of bias terms of each
+        layer of all the networks.  Note: these are not copies of
+        the weights.
+
+        weights may be a 2-dimensional array (k, n_weights) or a
+        one-dimensional array of all the weights (as used by the
+        scipy solvers).  If not provided, the weights of the stack
+        are used.
+        """
+
+        if weights is None:
+            return self.theta, self.bias
+
+        return weight_views(self.net,
+                            weights.reshape((self.k, self.n_weights)))
+
+    def initialize_weights(self, epsilon=0.01, method='xavier'):
+        """Set the weights of all networks to random values (see
+        MLPNetwork.initialize_weights).
+        """
+
+        if method == 'normal':
+            self.weights[:] = np.random.randn(*self.weights.shape)*epsilon
+        elif method in ('he', 'xavier'):
+            n = 2.0 if method == 'he' else 1.0
+            for t, b in zip(self.theta[1:], self.bias[1:]):
+                epsilon = np.sqrt(n/(t.shape[2] + 1))
+                t[:] = np.random.standard_normal(t.shape)*epsilon
+                b[:] = np.random.standard_normal(b.shape)*epsilon
+        else:
+            raise ValueError("Invalid value for keyword argument 'method'")
+
+    def predict(self, inputs, weights=None):
+        """Returns the predictions of all networks for the inputs
+        as a 3-dimensional array (k, m, n_out).
+        """
+
+        inputs = np.asarray(inputs, dtype=self.dtype)
+        if len(inputs.shape) == 1:
+            inputs = inputs.reshape((1, inputs.shape[0]))
+
+        theta, bias = self.get_layer_params(weights=weights)
+
+        outputs = (inputs - self.mu)/self.sigma
+        for j, layer in enumerate(self.net.layers[1:], start=1):
+            z = np.matmul(outputs, theta[j].transpose(0, 2, 1))
+            z += bias[j][:, None, :]
+            activate(layer, z, z)
+            outputs = z
+
+        return outputs
+
+    def get_network(self, i, name=None):
+        """Returns a new MLPNetwork with a copy of the weights of
+        network i in the stack.
+        """
+
+        net = MLPNetwork(
+            self.net.dimensions,
+            name=name,
+            act_funcs=self.net.get_act_funcs(),
+            mu=self.mu,
+            sigma=self.sigma,
+            dtype=self.dtype
+        )
+        net.cost_function = self.net.cost_function
+        net.weights[:] = self.weights[i]
+
+        return net
+
+    def __repr__(self):
+
+        return "MLPNetworkStack(%s, k=%d)" % (self.net.__repr__(), self.k)
+
+
+def initialize_stack_arrays(stack, m, dtype=None, training_data=None):
+    """Returns a dictionary of the arrays needed to calculate the
+    cost function and gradients of a stack of networks
+    (MLPNetworkStack) with m training data points.  These are the
+    same as the arrays created by initialize_arrays with an extra
+    first dimension of size k (except A[0] which contains the
+    training data inputs and is shared by all the networks).
+    If training_data is provided, A[0] is set to its inputs (see
+    initialize_input_array).
+    """
+
+    if dtype is None:
+        dtype = stack.dtype
+
+    net, k = stack.net, stack.k
+
+    A = [None]*net.n_layers
+    Z = [None]*net.n_layers
+    sigma = [None]*net.n_layers
+
+    A[0] = initialize_input_array(m, net.n_inputs, dtype, training_data)
+
+    D = [None]*net.n_layers
+
+    for j, layer in enumerate(net.layers[1:], start=1):
+        Z[j] = np.empty((k, m, layer.n_nodes), dtype=dtype)
+        sigma[j] = np.empty((k, m, layer.n_nodes), dtype=dtype)
+        if layer.act_func[0] is linear:
+            A[j] = Z[j]
+        else:
+            A[j] = np.empty((k, m, layer.n_nodes), dtype=dtype)
+        if layer.act_func[0] in fused_activation_functions:
+            D[j] = np.empty((k, m, layer.n_nodes), dtype=dtype)
+
+    grad = np.zeros((k, net.n_weights), dtype=dtype)
+
+    # Partial derivatives of error w.r.t. each weight and bias term
+    # (views of grad)
+    theta_grad, bias_grad = weight_views(net, grad)
+
+    return {
+        'A': A,
+        'Z': Z,
+        'sigma': sigma,
+        'grad': grad,
+        'theta_grad': theta_grad,
+        'bias_grad': bias_grad,
+        'D': D
+    }
 
-    *Note: This is also known as the Bernoulli negative log-
-    likelihood and binary cross-entropy. It should only be used for
-    problems such as classification where y values are either 0.0
-    or 1.0.
 
-    Arguments:
-    net           -- A neural network model (MLPNetwork).
-    training_data -- A set of training data (MLPTrainingData).
+def stack_feed_forward(stack, A, Z, theta, bias, D=None):
 
-    Keyword arguments:
-    weights       -- Provide a new set of weights to calculate the
-                     cost function (current network weights will not
-                     be affected).  If not specified, the cost
-                     function will use the current weights stored in
-                     the network.
-    lambda_param  -- Regularization term.  If not specified then
-                     default is lambda_param=0.0 (i.e. no
-                     regularization).
-    jac           -- If set to None or False then this function does
-                     not calculate or return the Jacobian matrix (of
-                     gradients).
-    cache         -- (optional) provide a set of existing arrays
-                     to avoid re-initializaing arryas each time this
-                     cost function is calculated. If cache is None,
-                     new (empty) arrays will be initialized.
+    net = stack.net
+
+    if D is None:
+        D = [None]*net.n_layers
+
+    for j, layer in enumerate(net.layers[1:], start=1):
+
+        # A[0] is 2-dimensional so it is broadcast over all the
+        # networks in the stack
+        np.matmul(A[j - 1], theta[j].transpose(0, 2, 1), out=Z[j])
+        Z[j] += bias[j][:, None, :]
+
+        activate(layer, Z[j], A[j], D[j])
+
+
+def stack_back_prop(stack, sigma, A, Z, theta, theta_grad, bias_grad,
+                    lambda_param, D=None):
+
+    net = stack.net
+    m = A[0].shape[0]
+
+    if D is None:
+        D = [None]*net.n_layers
+
+    for j in range(net.n_layers - 2, 0, -1):
+        np.matmul(sigma[j + 1], theta[j + 1], out=sigma[j])
+        multiply_derivatives(net.layers[j], sigma[j], Z[j], A[j], D[j])
+
+    for j, layer in enumerate(net.layers[1:], start=1):
+
+        np.matmul(sigma[j].transpose(0, 2, 1), A[j - 1], out=theta_grad[j])
+        np.sum(sigma[j], axis=1, out=bias_grad[j])
+        bias_grad[j] /= m
+
+        # Add component for regularization (in place, see back_prop)
+        theta_grad[j] /= m
+        if lambda_param != 0.0:
+            for i in range(stack.k):
+                add_scaled(theta_grad[j][i], lambda_param/m, theta[j][i])
+
+
+def cost_function_stack(stack, training_data, weights=None,
+                        lambda_param=0.0, jac=True, cache=None):
+    """Computes the cost functions (J) and gradients (grad) of all
+    the networks in a stack (MLPNetworkStack) on the training_data.
+    The cost function of the template network (stack.net) is used
+    ('log' or 'mse').  See cost_function_log and cost_function_mse.
 
     Returns:
-    (J, grad)     -- Cost and gradients matrix.
+    (J, grad)  -- one-dimensional array (k, ) of costs and
+                  2-dimensional array (k, n_weights) of gradients.
     """
 
-    # Inputs and desired outputs from training data
-    X, Y = training_data.inputs, training_data.outputs
-
-    # Number of examples in training data set
+    net = stack.net
+    Y = training_data.outputs
     m = Y.shape[0]
 
     if cache is None:
-        # initialize all arrays as new (empty) arrays
-        cache = initialize_arrays(net, m)
-
-        # Assign training data inputs to A[0]
-        cache['A'][0][:, 1:] = X
+        cache = initialize_stack_arrays(stack, m,
+                                        training_data=training_data)
 
     A = cache['A']
     Z = cache['Z']
-    sigma =  cache['sigma']
-    grad = cache['grad']
+    sigma = cache['sigma']
     theta_grad = cache['theta_grad']
+    bias_grad = cache['bias_grad']
 
-    # Get the weights of each layer as a list of 2-dimensional arrays,
-    # either from the network or from the set of weights provided.
-    theta = net.get_theta(weights=weights)
+    D = cache.get('D')
 
-    # Calculate A and Z
-    feed_forward(net, A, Z, theta)
+    theta, bias = stack.get_layer_params(weights=weights)
 
-    # Cost function
-    # Negative log-likelihood of the Bernoulli distribution
-    # (vectorized)
-    # This only works with data sets where y = 0.0 or 1.0.
-    try:
-        J = np.sum(-Y*np.log(A[-1]) - (1.0 - Y)*np.log(1.0 - A[-1]))/m
-    except FloatingPointError:
-        n_zeros = np.sum(np.any(A[-1] == 0.0))
-        n_ones = np.sum(np.any(A[-1] == 1.0))
-        messages = ["FloatingPointError occurred."]
-        if n_zeros > 0:
-            messages.append("%d network output values are 0.0." % n_zeros)
-        if n_ones > 0:
-            messages.append("%d network output values are 1.0." % n_ones)
-        raise ValueError( " ".join(messages))
-    # Note: numpy will only raise a warning or error if
-    # np.seterr(all='raise')
+    stack_feed_forward(stack, A, Z, theta, bias, D)
 
-    # Add regularization terms
-    if lambda_param != 0.0:
+    if net.cost_function is cost_function_log:
+        J = np.sum(sigmoid_cross_entropy(Z[-1], Y), axis=(1, 2))/m
+    elif net.cost_function is cost_function_mse:
+        J = 0.5*np.sum((A[-1] - Y)**2, axis=(1, 2))/m
+    else:
+        raise MLPError("Unrecognised cost function assigned to network.")
 
-        for j, layer in enumerate(net.layers[1:], start=1):
-            J = J + lambda_param*np.sum(theta[j][:, 1:]**2)/(2.0*m)
+    if lambda_param != 0.0:
+        for j in range(1, net.n_layers):
+            J += lambda_param*np.sum(theta[j]**2, axis=(1, 2))/(2.0*m)
 
-    # If jac is set to None or False then don't calculate
-    # the gradient and end here
     if not jac:
         return J
 
-    # Otherwise, gradients will be calculated and
-    # added to the array grad which has the same
-    # dimensions as weights
-    # grad = np.zeros(self.n_weights, dtype=np.float)
+    np.subtract(A[-1], Y, out=sigma[-1])
+    if net.cost_function is cost_function_log:
+        assert net.layers[-1].act_func is activation_functions["sigmoid"]
+    else:
+        multiply_derivatives(net.layers[-1], sigma[-1], Z[-1], A[-1],
+                             None if D is None else D[-1])
 
-    # sigma, delta and theta_grad arrays will be calculated
-    # for each layer.
+    stack_back_prop(stack, sigma, A, Z, theta, theta_grad, bias_grad,
+                    lambda_param, D)
 
-    # Calculate dJ/dZ (sigma) for the output layer
-    # TODO: Change sigma to dZ for consistency with A Ng course
-    # For negative log-likelihood cost function and with
-    # the sigmoid function in the output layer, sigma is
-    # simply A - Y:
-    assert net.layers[-1].act_func is activation_functions["sigmoid"]
-    sigma[-1] = A[-1] - Y
+    return (J, cache['grad'])
 
-    # Back-propagate to calculate derivatives
-    back_prop(net, sigma, A, Z, theta, theta_grad, lambda_param)
 
-    return (J, grad)
+def stack_line_search(cost, x, d, f, g, active, c1=1e-4, max_iter=20):
+    """Backtracking line search for the networks of a stack.  Each
+    row of x (k, n_weights) is moved along the same row of the
+    search directions d until the sufficient decrease (Armijo)
+    condition is met, with the step length of each row chosen
+    separately.  The trial weights of all the rows are evaluated
+    together by cost, which returns a tuple (J, grad) of arrays of
+    shape (k, ) and (k, n_weights).
 
+    Arguments:
+    cost   -- cost function of the stack (see train_stack).
+    x      -- current weights (k, n_weights).
+    d      -- search directions (k, n_weights).
+    f, g   -- cost and gradients at x.
+    active -- boolean array (k, ) of the rows to search.  The other
+              rows are evaluated at x.
+
+    Returns a tuple (alpha, f_new, g_new) of the step length of
+    each row and the cost and gradients at x + alpha*d.  alpha is
+    nan for the rows where no step was found within max_iter
+    evaluations (and for the rows not in active).
+    """
 
-def cost_function_mse(net, training_data, weights=None,
-                      lambda_param=0.0, jac=True, cache=None):
-    """Computes the cost function (J) and gradients (grad) of the
-    network on the training_data with the mean-squared-error cost
-    function* using back-propagation.
+    slope = np.einsum('ij,ij->i', g, d)
+    step = np.where(active, 1.0, 0.0)
+    pending = active.copy()
+
+    alpha = np.full(len(f), np.nan)
+    f_new = f.copy()
+    g_new = g.copy()
+
+    for i in range(max_iter):
+        J, grad = cost(x + step[:, None]*d)
+
+        with np.errstate(invalid='ignore'):
+            done = pending & (J <= f + c1*step*slope)
+        alpha[done] = step[done]
+        f_new[done] = J[done]
+        g_new[done] = grad[done]
+        pending &= ~done
+        if not pending.any():
+            break
+
+        # Minimum of the quadratic through f, slope and J, kept
+        # within [0.1, 0.5] times the last step
+        with np.errstate(invalid='ignore', divide='ignore',
+                         over='ignore'):
+            trial = -slope*step**2/(2.0*(J - f - slope*step))
+        trial = np.where(np.isfinite(trial), trial, 0.5*step)
+        trial = np.clip(trial, 0.1*step, 0.5*step)
+        step = np.where(pending, trial, 0.0)
+
+    return alpha, f_new, g_new
+
+
+def train_stack(stack, training_data, max_iter=1, update=True,
+                lambda_param=0.0, memory=10, gtol=1e-6, ftol=0.01,
+                messages=True):
+    """Trains all the networks in a stack (MLPNetworkStack) at the
+    same time on a set of training data.
+
+    Each network is trained by its own limited-memory BFGS (L-BFGS)
+    solver (see Trainer): it has its own search direction, line
+    search (see stack_line_search), curvature history and
+    convergence tests, so the result of each network does not
+    depend on the other networks in the stack (e.g. for random
+    restarts).  Only the cost functions of all the networks are
+    calculated together (see cost_function_stack).  A network stops
+    when it has converged while the others continue.
 
-    *Note: This cost function is also known as the maximum likelihood
-    or sum-squared error method. It is generally useful for
-    regression and function approximation problems.
+    Arguments:
+    stack         -- MLPNetworkStack object.
+    training_data -- MLPTrainingData object.
+
+    Keyword Arguments:
+    max_iter      -- Maximum number of iterations of each solver.
+    update        -- Set to False if you don't want to update the
+                     stack's weights at the end of the training.
+                     Default is True.
+    lambda_param  -- Regularization parameter.  Default is 0.0.
+    memory        -- number of previous steps used by the L-BFGS
+                     algorithm (see Trainer).  Default is 10.
+    gtol          -- A network stops when its maximum gradient is
+                     <= gtol.  Default is 1e-6.
+    ftol          -- A network stops when the relative reduction in
+                     its cost function is <= ftol*(machine epsilon).
+                     Default is 0.01.
+    messages      -- Set to True to print the reason each solver
+                     stopped.
+
+    Returns a scipy.optimize.OptimizeResult object.  x and jac are
+    the weights and gradients (k, n_weights), fun contains the
+    final cost of each network, nit, success and message the
+    number of iterations, result and reason each solver stopped,
+    and nfev the number of evaluations of the cost functions of the
+    stack.  Its attribute costs is the same as fun and best is the
+    index of the network with the lowest cost.
+    """
+
+    m = training_data.inputs.shape[0]
+    k = stack.k
+
+    arrays = initialize_stack_arrays(stack, m,
+                                     training_data=training_data)
+
+    weights = np.empty_like(stack.weights)
+    n_eval = [0]
+
+    def cost(x):
+        weights[:] = x
+        J, grad = cost_function_stack(
+            stack,
+            training_data,
+            weights=weights,
+            lambda_param=lambda_param,
+            jac=True,
+            cache=arrays
+        )
+        n_eval[0] += 1
+        return J.astype(np.float64), grad.astype(np.float64)
+
+    # State of the solver of each network
+    x = stack.weights.astype(np.float64)
+    f, g = cost(x)
+    f_previous = f.copy()
+    s = [deque(maxlen=memory) for i in range(k)]
+    y = [deque(maxlen=memory) for i in range(k)]
+    n_iter = np.zeros(k, dtype=int)
+    success = np.zeros(k, dtype=bool)
+    message = ["Maximum number of iterations reached."]*k
+
+    # Networks that have not stopped
+    active = np.ones(k, dtype=bool)
+
+    for i in range(max_iter):
+
+        for n in np.flatnonzero(active):
+            if np.max(np.abs(g[n])) <= gtol:
+                message[n] = "Gradient is less than gtol."
+                success[n] = True
+                active[n] = False
+        if not active.any():
+            break
+
+        d = np.zeros_like(x)
+        for n in np.flatnonzero(active):
+            d[n] = lbfgs_direction(g[n], s[n], y[n])
+            if np.dot(d[n], g[n]) >= 0.0:
+                s[n].clear()
+                y[n].clear()
+                d[n] = lbfgs_direction(g[n], s[n], y[n])
+
+        alpha, f_new, g_new = stack_line_search(cost, x, d, f, g, active)
+
+        for n in np.flatnonzero(active):
+
+            if np.isnan(alpha[n]):
+                if s[n]:
+                    # Try again without the curvature information
+                    s[n].clear()
+                    y[n].clear()
+                    continue
+                message[n] = "Line search failed."
+                active[n] = False
+                continue
+
+            x_new = x[n] + alpha[n]*d[n]
+            s_n = x_new - x[n]
+            y_n = g_new[n] - g[n]
+            if np.dot(s_n, y_n) > 1e-10:
+                s[n].append(s_n)
+                y[n].append(y_n)
+
+            f_previous[n] = f[n]
+            x[n], f[n], g[n] = x_new, f_new[n], g_new[n]
+            n_iter[n] += 1
+
+            if (f_previous[n] - f[n]) <= ftol*np.finfo(float).eps* \
+                    max(abs(f_previous[n]), abs(f[n]), 1.0):
+                message[n] = "Relative reduction of cost is less " \
+                             "than ftol."
+                success[n] = True
+                active[n] = False
+
+    if update:
+        stack.weights[:] = x
+
+    stack.mu, stack.sigma = training_data.mu, training_data.sigma
+
+    res = OptimizeResult(
+        x=x,
+        fun=f,
+        jac=g,
+        nit=n_iter,
+        nfev=n_eval[0],
+        success=success,
+        message=message
+    )
+    res.costs = f.copy()
+    res.best = int(np.argmin(res.costs))
+
+    if messages:
+        print("Solver returned the following messages:")
+        for n in range(k):
+            print("%d: %s" % (n, message[n]))
+
+    return res
+
+
+# ------------------ HYPERPARAMETER SEARCH ----------------------
+
+# Functions to train many networks with randomly-chosen dimensions,
+# activation functions and regularization parameters (similar to
+# xor_test) in parallel processes and find the most successful.
+
+# Environment variables that limit the number of threads used by
+# the BLAS libraries numpy may be linked to
+blas_thread_variables = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS'
+)
+
+# Data sets used by run_trial in each worker process
+# (see init_search_worker)
+search_data = {}
+
+
+@contextmanager
+def blas_threads(n_threads):
+    """Context manager which sets the environment variables that
+    limit the number of BLAS threads.  These only affect new
+    processes started (with the 'spawn' or 'forkserver' methods)
+    inside the with statement, not the current process.
+    """
+
+    saved = {name: os.environ.get(name) for name in blas_thread_variables}
+    for name in blas_thread_variables:
+        os.environ[name] = str(n_threads)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def init_search_worker(training_data, validation_data):
+    """Initializes a worker process for random_search.  The data
+    sets are sent to each worker once and kept in search_data.
+    """
+
+    search_data['training'] = training_data
+    search_data['validation'] = validation_data
+
+    # The environment variables set by blas_threads should have
+    # limited the BLAS libraries to one thread but threadpoolctl
+    # (if it is installed) can make sure
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        search_data['limits'] = threadpool_limits(limits=1)
+
+
+def random_trial(trial, n_in, n_out, seed=0, hidden_layers=(1, 2),
+                 hidden_nodes=(2, 10), act_funcs=None,
+                 lambda_params=(0.0, 0.001, 0.01, 0.1, 0.5, 1.0),
+                 cost_function='mse'):
+    """Returns a dictionary of randomly-chosen parameters for a
+    network to be trained by run_trial.  The same trial number and
+    seed always produce the same parameters.
 
     Arguments:
-    net           -- A neural network model (MLPNetwork).
-    training_data -- A set of training data (MLPTrainingData).
+    trial         -- trial number (int).
+    n_in, n_out   -- number of network inputs and outputs.
 
     Keyword arguments:
-    weights       -- Provide a new set of weights to calculate the
-                     cost function (current network weights will not
-                     be affected).  If not specified, the cost
-                     function will use the current weights stored in
-                     the network.
-    lambda_param  -- Regularization term.  If not specified then
-                     default is lambda_param=0.0 (i.e. no
-                     regularization).
-    jac           -- If set to None or False then this function does
-                     not calculate or return the Jacobian matrix (of
-                     gradients).
-    cache         -- (optional) provide a set of existing arrays
-                     to avoid re-initializaing arryas each time this
-                     cost function is calculated. If cache is None,
-                     new (empty) arrays will be initialized.
+    seed          -- seed for the random number generator.
+    hidden_layers -- range (min, max) of the number of hidden layers.
+    hidden_nodes  -- range (min, max) of the number of nodes in each
+                     hidden layer.
+    act_funcs     -- list of names of activation functions to choose
+                     from.  Default is all functions in
+                     activation_functions.
+    lambda_params -- values of the regularization parameter to
+                     choose from.
+    cost_function -- cost function ('mse' or 'log').  If 'log', the
+                     sigmoid function is used in the output layer.
+    """
 
-    Returns:
-    (J, grad)     -- Cost and gradients matrix.
+    rng = np.random.RandomState([seed, trial])
+
+    if act_funcs is None:
+        act_funcs = sorted(activation_functions.keys())
+
+    ndim = [n_in]
+    for i in range(rng.randint(hidden_layers[0], hidden_layers[1] + 1)):
+        ndim.append(int(rng.randint(hidden_nodes[0], hidden_nodes[1] + 1)))
+    ndim.append(n_out)
+
+    act_func_names = [str(rng.choice(act_funcs)) for d in ndim[1:]]
+    if cost_function == 'log':
+        act_func_names[-1] = 'sigmoid'
+
+    return {
+        'trial': trial,
+        'ndim': ndim,
+        'act_funcs': act_func_names,
+        'cost_function': cost_function,
+        'lambda_param': float(rng.choice(lambda_params)),
+        'seed': int(rng.randint(2**31))
+    }
+
+
+def run_trial(params, max_iter=100, n_rounds=10, patience=3,
+              target_cost=None, dtype=None):
+    """Trains a new network with the parameters provided (see
+    random_trial) on the training data set in search_data and
+    returns a dictionary of results.
+
+    The network is trained for up to n_rounds rounds of max_iter
+    iterations by one Trainer so the arrays used to calculate the
+    cost function and the state of the solver are kept from one
+    round to the next.  After each round, the cost on the validation
+    data (or the training data if there is none) is calculated.
+    Training stops early if this cost is less than target_cost or
+    has not improved for patience rounds, or if the solver made no
+    progress.
     """
 
-    # Inputs and desired outputs from training data
-    X, Y = training_data.inputs, training_data.outputs
+    training_data = search_data['training']
+    validation_data = search_data.get('validation')
+    if validation_data is None:
+        validation_data = training_data
+
+    np.random.seed(params['seed'])
+    net = MLPNetwork(
+        params['ndim'],
+        act_funcs=params['act_funcs'],
+        cost_function=params['cost_function'],
+        dtype=dtype
+    )
+    net.initialize_weights()
+    lambda_param = params['lambda_param']
 
-    # Number of examples in training data set
-    m = Y.shape[0]
+    trainer = Trainer(net, training_data, lambda_param=lambda_param)
+    validation_cost = CostEvaluator(net, validation_data)
 
-    if cache is None:
-        # initialize all arrays as new (empty) arrays
-        cache = initialize_arrays(net, m)
+    best_cost = np.inf
+    best_weights = net.weights.copy()
+    n_iter = 0
+    n_bad_rounds = 0
 
-        # Assign training data inputs to A[0]
-        cache['A'][0][:, 1:] = X
+    for r in range(n_rounds):
+        res = trainer.train(max_iter=max_iter)
+        n_iter += res.nit
 
-    A = cache['A']
-    Z = cache['Z']
-    sigma =  cache['sigma']
-    grad = cache['grad']
-    theta_grad = cache['theta_grad']
+        cost = validation_cost()
 
-    # Get the weights of each layer as a list of 2-dimensional arrays,
-    # either from the network or from the set of weights provided.
-    theta = net.get_theta(weights=weights)
+        if cost < best_cost:
+            best_cost = cost
+            best_weights[:] = net.weights
+            n_bad_rounds = 0
+        else:
+            n_bad_rounds += 1
 
-    # Calculate A and Z
-    feed_forward(net, A, Z, theta)
+        if (target_cost is not None and cost < target_cost) or \
+                n_bad_rounds >= patience or not np.isfinite(cost) or \
+                res.nit == 0:
+            break
 
-    # Regular mean-squared-error (MSE) cost function
-    J = 0.5*np.sum((A[-1] - Y)**2)/m
+    net.weights[:] = best_weights
 
-    # Add regularization terms
-    if lambda_param != 0.0:
+    result = dict(params)
+    result.update({
+        'cost': float(best_cost),
+        'train_cost': float(net.cost_function(net, training_data,
+                                              jac=False,
+                                              cache=trainer.cache)),
+        'n_iter': int(n_iter),
+        'n_rounds': r + 1
+    })
 
-        for j, layer in enumerate(net.layers[1:], start=1):
-            J = J + lambda_param*np.sum(theta[j][:, 1:]**2)/(2.0*m)
+    return result
 
-    # If jac is set to None or False then don't calculate
-    # the gradient and end here
-    if not jac:
-        return J
 
-    # Otherwise, gradients will be calculated and
-    # added to the array grad which has the same
-    # dimensions as weights
-    # grad = np.zeros(self.n_weights, dtype=np.float)
+def random_search(training_data, validation_data=None, n_trials=20,
+                  n_workers=None, results_file=None, seed=0, max_iter=100,
+                  n_rounds=10, patience=3, target_cost=None, dtype=None,
+                  messages=True, **space):
+    """Trains n_trials networks with randomly-chosen dimensions,
+    activation functions and regularization parameters in parallel
+    processes and returns a list of the results (dictionaries) sorted
+    by cost (lowest first).
 
-    # sigma, delta and theta_grad arrays will be calculated
-    # for each layer.
+    Each worker process trains one network at a time using one BLAS
+    thread so that n_workers networks are trained at the same time.
+    The data sets are sent to each worker once when it starts.
 
-    # Calculate dJ/dZ (sigma) for the output layer:
-    # TODO: Change sigma to dZ for consistency with A Ng course
-    if net.layers[-1].act_func is activation_functions["sigmoid"]:
-        sigma[-1][:] = (A[-1] - Y)*A[-1]*(1 - A[-1])
-    elif net.layers[-1].act_func is activation_functions["tanh"]:
-        sigma[-1][:] = (A[-1] - Y)*(1 - A[-1]**2)
-    else:
-        sigma[-1][:] = (A[-1] - Y)*net.layers[-1].act_func[1](Z[-1])
+    Arguments:
+    training_data   -- MLPTrainingData object.
 
-    # Back-propagate to calculate derivatives
-    back_prop(net, sigma, A, Z, theta, theta_grad, lambda_param)
+    Keyword arguments:
+    validation_data -- (optional) MLPTrainingData object used to
+                       evaluate the networks.  If not provided, the
+                       cost on the training data is used.
+    n_trials        -- number of networks to train.
+    n_workers       -- number of worker processes.  Default is the
+                       number of CPUs.
+    results_file    -- (optional) name of a file to which the result
+                       of each trial is added (one JSON record per
+                       line) as soon as it is finished.  If the file
+                       already exists, trials it contains are not
+                       repeated so an interrupted search can be
+                       resumed by calling random_search again with
+                       the same arguments.
+    seed            -- seed used to choose the parameters of each
+                       trial (see random_trial).
+    max_iter, n_rounds, patience, target_cost --
+                       training and early stopping parameters (see
+                       run_trial).
+    dtype           -- data type of the networks.
+    messages        -- Set to False to stop progress messages being
+                       printed.
+
+    Any other keyword arguments (e.g. hidden_layers, act_funcs,
+    cost_function) define the parameters to choose from (see
+    random_trial).
+    """
 
-    return (J, grad)
+    n_in, n_out = training_data.n_in, training_data.n_out
+
+    results = []
+    if results_file is not None and os.path.exists(results_file):
+        with open(results_file) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+
+    done = set(result['trial'] for result in results)
+    trials = [random_trial(i, n_in, n_out, seed=seed, **space)
+              for i in range(n_trials) if i not in done]
+
+    if messages and done:
+        print("%d trials already completed." % len(done))
+
+    if trials:
+
+        # New processes are started with the 'spawn' method so that
+        # the BLAS thread limits are set before numpy is imported
+        context = multiprocessing.get_context('spawn')
+
+        with blas_threads(1), ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    mp_context=context,
+                    initializer=init_search_worker,
+                    initargs=(training_data, validation_data)
+                ) as executor:
+
+            futures = [
+                executor.submit(run_trial, params, max_iter=max_iter,
+                                n_rounds=n_rounds, patience=patience,
+                                target_cost=target_cost, dtype=dtype)
+                for params in trials
+            ]
+
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+
+                if results_file is not None:
+                    with open(results_file, 'a') as f:
+                        f.write(json.dumps(result) + "\n")
+
+                if messages:
+                    print("Trial %d: ndim=%s, act_funcs=%s, lambda=%g, "
+                          "cost=%.5g" % (result['trial'], result['ndim'],
+                                         result['act_funcs'],
+                                         result['lambda_param'],
+                                         result['cost']))
+
+    results.sort(key=lambda result: result['cost'])
+
+    return results
+
+
+def summarize_search(results, max_cost=0.01, n=5):
+    """Prints a summary of the features of the most successful
+    networks (those with a cost less than max_cost) from the results
+    returned by random_search.
+    """
+
+    successes = [r for r in results if r['cost'] < max_cost]
+
+    print("\nSummary: %d out of %d trials successful." % (len(successes),
+                                                        len(results)))
+
+    if not successes:
+        return
+
+    print("\nNumber of hidden layers:")
+    print_list([("%d: %d" % item) for item in
+                top_ranked([len(r['ndim']) - 2 for r in successes])[:n]])
+
+    print("\nTotal number of neurons:")
+    print_list([("%d: %d" % item) for item in
+                top_ranked([sum(r['ndim'][1:]) for r in successes])[:n]])
+
+    print("\nOutput layer act_func:")
+    print_list([("%s: %d" % item) for item in
+                top_ranked([r['act_funcs'][-1] for r in successes])[:n]])
+
+    print("\nAct_func combination:")
+    print_list([("%s: %d" % item) for item in
+                top_ranked([tuple(r['act_funcs']) for r in successes])[:n]])
+
+    print("\nLambda:")
+    print_list([("%s: %d" % item) for item in
+                top_ranked([r['lambda_param'] for r in successes])[:n]])
+
+    print("\nBest trials:")
+    for r in successes[:n]:
+        print("%d: ndim=%s, act_funcs=%s, lambda=%g, cost=%.5g" % (
+            r['trial'], r['ndim'], r['act_funcs'], r['lambda_param'],
+            r['cost']))
 
 
 # THE FOLLOWING FUNCTION IS ONLY FOR TESTING!
@@ -1525,7 +4991,7 @@ def initialize_weights(fan_out, fan_in):
 # THE FOLLOWING FUNCTION IS ONLY FOR TESTING!
 
 def random_act_func():
-     return np.random.choice(activation_functions.keys())
+     return np.random.choice(list(activation_functions.keys()))
 
 def set_act_funcs(net, act_funcs):
      for i, act_func in enumerate(act_funcs):
@@ -1709,7 +5175,7 @@ def check_gradients(lambda_param=0.0):
 
     # Reusing initialize_weights to generate X
     X = initialize_weights(m, input_layer_size - 1)
-    y = np.zeros((m, num_labels), dtype=np.float)
+    y = np.zeros((m, num_labels), dtype=np.float64)
     for i, v in enumerate(np.arange(1, m+1) % num_labels):
         y[i, v] = 1.0
 
@@ -1793,22 +5259,30 @@ def checkActFuncGradients(func_list):
 #        to theta(i).)
 #
 
-def compute_derivative_numerically(J, theta, epsilon=1.0e-7):
+def compute_derivative_numerically(J, theta, epsilon=1.0e-7,
+                                   indices=None):
     """Returns a numerical estimate of the partial derivatives of J
     (the gradients) for each value of theta using linear approximation.
+
+    If an array of indices is provided, only the partial derivatives
+    with respect to theta[indices] are estimated and returned.
     """
 
-    numgrad = np.zeros(theta.shape)
     perturb = np.zeros(theta.shape)
 
-    n = len(theta)
+    if indices is None:
+        indices = range(len(theta))
+
+        n = len(theta)
+
+        if n > 1000:
+            print("Warning: Computing the numerical gradients with %d" % n)
+            print("weights could take a long time!")
+            input("Program paused. Press enter to continue.")
 
-    if n > 1000:
-        print("Warning: Computing the numerical gradients with %d" % n)
-        print("weights could take a long time!")
-        input("Program paused. Press enter to continue.")
+    numgrad = np.zeros(len(indices))
 
-    for p in range(n):
+    for i, p in enumerate(indices):
 
         # Set perturbation vector
         perturb[p] = epsilon
@@ -1822,12 +5296,376 @@ def compute_derivative_numerically(J, theta, epsilon=1.0e-7):
             loss2 = loss2[0]
 
         # Compute Numerical Gradient
-        numgrad[p] = (loss2 - loss1) / (2.0*epsilon)
+        numgrad[i] = (loss2 - loss1) / (2.0*epsilon)
         perturb[p] = 0.0
 
     return numgrad
 
 
+def compute_directional_derivatives(J, theta, directions, epsilon=1.0e-7):
+    """Returns numerical estimates of the derivatives of J at theta
+    in each of the directions provided (rows of the 2-dimensional
+    array directions) using linear approximation.  If the directions
+    are unit vectors, these should be equal to the dot products of
+    the directions with the gradient of J.
+    """
+
+    derivatives = np.zeros(directions.shape[0])
+
+    for i, d in enumerate(directions):
+
+        loss1 = J(theta - epsilon*d)
+        loss2 = J(theta + epsilon*d)
+
+        if isinstance(loss1, tuple):
+            loss1 = loss1[0]
+
+        if isinstance(loss2, tuple):
+            loss2 = loss2[0]
+
+        derivatives[i] = (loss2 - loss1) / (2.0*epsilon)
+
+    return derivatives
+
+
+# THE FOLLOWING FUNCTIONS ARE ONLY FOR TESTING!
+
+def predict_concatenate(net, inputs, weights=None):
+    """Original implementation of MLPNetwork.predict which adds a
+    column of ones to the inputs of each layer (using
+    np.concatenate) to represent the bias terms.  Only used by
+    predict_benchmark for comparison.
+    """
+
+    inputs = np.asarray(inputs, dtype=net.dtype)
+    if len(inputs.shape) == 1:
+        inputs.shape = (1, inputs.shape[0])
+
+    m = inputs.shape[0]
+
+    theta, bias = net.get_layer_params(weights=weights)
+
+    outputs = (inputs - net.mu)/net.sigma
+
+    for j, layer in enumerate(net.layers[1:], start=1):
+
+        # Weights with the bias terms in the first column
+        weights_and_bias = np.concatenate(
+            (bias[j][:, None], theta[j]),
+            axis=1
+        )
+        outputs = layer.act_func[0](
+            np.dot(
+                np.concatenate(
+                    (np.ones((m, 1), dtype=net.dtype), outputs),
+                    axis=1
+                ),
+                weights_and_bias.T)
+        )
+
+    return outputs
+
+
+def predict_benchmark(ndim=(8, 64, 64, 1), m=10000, act_funcs="tanh",
+                      number=100):
+    """Compares the execution time of MLPNetwork.predict with the
+    original implementation (predict_concatenate) on a batch of m
+    random inputs.  Returns the best times per call in seconds as
+    a tuple (predict, predict_concatenate).
+    """
+
+    import timeit
+
+    net = MLPNetwork(list(ndim), act_funcs=act_funcs, cost_function='mse')
+    net.initialize_weights()
+    x = np.random.randn(m, ndim[0])
+
+    assert np.allclose(net.predict(x), predict_concatenate(net, x))
+
+    t_new = min(timeit.repeat(lambda: net.predict(x), number=number,
+                              repeat=3))/number
+    t_old = min(timeit.repeat(lambda: predict_concatenate(net, x),
+                              number=number, repeat=3))/number
+
+    print("ndim=%s, m=%d" % (str(list(ndim)), m))
+    print("predict:             %8.1f microseconds per call" % (t_new*1e6))
+    print("predict_concatenate: %8.1f microseconds per call" % (t_old*1e6))
+
+    return t_new, t_old
+
+
+# Timings recorded in the comments near the top of this module
+# (seconds per call).  Used by activation_benchmark for comparison.
+recorded_activation_timings = {
+    "sigmoid": (527e-9, 2.04e-6),
+    "arctan": (611e-9, 2.49e-6),
+    "tanh": (585e-9, 2.18e-6)
+}
+
+
+def activation_benchmark(shape=(10000, 64), number=100, dtype=None):
+    """Compares the execution time of each activation function and
+    its derivative function in the activation_functions dictionary
+    when a new array is returned and when the result is written to
+    an existing array (out argument) for an array of random inputs
+    of the given shape.  The timings recorded in the comments near
+    the top of this module are also shown where available.  Note
+    that these were not recorded with the same size of array.
+
+    Returns a dictionary of tuples (function, derivative function,
+    function with out, derivative function with out) of the best
+    times per call in seconds for each activation function.
+    """
+
+    import timeit
+
+    if dtype is None:
+        dtype = default_dtype
+
+    z = np.random.randn(*shape).astype(dtype)
+    out = np.empty_like(z)
+
+    def best(f):
+        return min(timeit.repeat(f, number=number, repeat=3))/number
+
+    print("shape=%s, dtype=%s (microseconds per call)" %
+          (str(shape), np.dtype(dtype).name))
+    print("%-8s %10s %10s %10s %10s %16s" % ("", "f(z)", "f(z, out)",
+          "df(z, a)", "df(z, a, out)", "recorded f, df"))
+
+    results = {}
+    for name, (f, df) in activation_functions.items():
+        a = f(z)
+        times = (
+            best(lambda: f(z)),
+            best(lambda: df(z, a)),
+            best(lambda: f(z, out=out)),
+            best(lambda: df(z, a, out=out))
+        )
+        results[name] = times
+
+        recorded = recorded_activation_timings.get(name)
+        recorded = "" if recorded is None else \
+                   "%7.2f %7.2f" % (recorded[0]*1e6, recorded[1]*1e6)
+        print("%-8s %10.1f %10.1f %10.1f %10.1f %16s" %
+              ((name, times[0]*1e6, times[2]*1e6, times[1]*1e6,
+                times[3]*1e6, recorded)))
+
+    return results
+
+
+def check_memory_plan(ndim=(16, 64, 32, 1), m=20000,
+                      act_funcs=('tanh', 'relu', 'linear'),
+                      memory_budget=2**22, rtol=0.05, atol=2**16):
+    """Compares the numbers of bytes estimated by memory_plan with
+    the memory allocated by numpy (measured with tracemalloc) for
+    each stage and prints the results.  Returns True if all the
+    measurements are within rtol (relative) plus atol bytes of the
+    estimates (or, for the chunked cost function and mini-batches,
+    within memory_budget).  atol allows for small objects such as
+    the state of the random number generator.
+    """
+
+    import tracemalloc
+
+    np.random.seed(0)
+    net = MLPNetwork(list(ndim), act_funcs=list(act_funcs),
+                     cost_function='mse')
+    net.initialize_weights()
+    data = MLPTrainingData(inputs=np.random.randn(m, ndim[0]),
+                           outputs=np.random.randn(m, ndim[-1]))
+    plan = memory_plan(net, m, memory_budget=memory_budget,
+                       optimizer='adam')
+
+    def measure(f):
+        """Returns (retained, peak) bytes allocated by f()."""
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        result = f()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        return current - start, peak - start
+
+    def arrays():
+        return initialize_arrays(net, m, training_data=data)
+
+    def split():
+        data.split(seed=0)
+        return data.subsets
+
+    def split_copies():
+        return [subset.get_arrays() for subset in data.subsets]
+
+    def chunked():
+        cache = initialize_chunked_arrays(net, m,
+                                          memory_budget=memory_budget)
+        return net.cost_function(net, data, cache=cache)
+
+    def minibatch():
+        return train_minibatch(net, data, batch_size=plan['batch_size'],
+                               update=False)
+
+    # (name, function, estimate, measurement used, limit only)
+    checks = [
+        ('arrays', arrays, plan['arrays'] + plan['grad'], 0, False),
+        ('predict', lambda: net.predict(data.inputs), plan['predict'], 1,
+         False),
+        ('split', split, plan['split'], 1, False),
+        ('split_copies', split_copies, plan['split_copies'], 0, False),
+        ('chunked', chunked, memory_budget, 1, True),
+        ('minibatch', minibatch, memory_budget, 1, True)
+    ]
+
+    print("%-14s %12s %12s" % ("", "estimate", "measured"))
+    success = True
+    for name, f, estimate, i, limit in checks:
+        measured = measure(f)[i]
+        if limit:
+            ok = measured <= estimate
+        else:
+            ok = abs(measured - estimate) <= rtol*estimate + atol
+        success = success and ok
+        print("%-14s %12d %12d %s" % (name, estimate, measured,
+                                      "" if ok else "FAILED"))
+
+    return success
+
+
+def check_allocations(ndim=(16, 64, 32, 1), m_values=(20000, 100000),
+                      act_funcs=('tanh', 'relu', 'linear'),
+                      cost_function='mse', lean=False, lambda_param=0.5):
+    """Measures (with tracemalloc) the peak memory allocated by one
+    evaluation of the cost function and gradients with a cache of
+    arrays (after one evaluation to warm up) for each number of
+    rows in m_values, and prints the results.  Returns True if
+    back_prop only allocated a few small python objects and if the
+    peak memory of the whole evaluation is the same for all numbers
+    of rows and less than twice numpy's buffer size.
+
+    The only memory numpy allocates is the buffer it uses to add the
+    bias terms to each row (at most np.getbufsize() elements) which
+    does not depend on the number of rows.  With the default
+    m_values each array for the training data is larger than this
+    limit so any array allocated would be detected.
+    """
+
+    import tracemalloc
+
+    np.random.seed(0)
+    net = MLPNetwork(list(ndim), act_funcs=list(act_funcs),
+                     cost_function=cost_function)
+    net.initialize_weights()
+    weights = net.weights.copy()
+
+    def peak(f):
+        f()
+        tracemalloc.start()
+        f()
+        result = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result
+
+    limit = 2*np.getbufsize()*net.dtype.itemsize
+    peaks = []
+    success = True
+    print("%8s %16s %16s" % ("m", "back_prop", "cost function"))
+    for m in m_values:
+        outputs = np.random.rand(m, ndim[-1])
+        if cost_function == 'log':
+            outputs = np.round(outputs)
+        data = MLPTrainingData(inputs=np.random.randn(m, ndim[0]),
+                               outputs=outputs)
+        cache = initialize_arrays(net, m, training_data=data, lean=lean)
+        theta, bias = net.get_layer_params(weights=weights)
+
+        def evaluate():
+            net.cost_function(net, data, weights=weights,
+                              lambda_param=lambda_param, cache=cache)
+
+        def backward():
+            back_prop(net, cache['sigma'], cache['A'], cache['Z'], theta,
+                      cache['theta_grad'], cache['bias_grad'],
+                      lambda_param, cache['D'])
+
+        evaluate()
+        peaks.append((peak(backward), peak(evaluate)))
+        print("%8d %16d %16d" % ((m, ) + peaks[-1]))
+
+        if peaks[-1][0] >= 4096 or peaks[-1][1] >= limit:
+            success = False
+
+    if max(p[1] for p in peaks) - min(p[1] for p in peaks) >= 4096:
+        success = False
+
+    return success
+
+
+def check_regularization(ndim=(4, 8, 2), m=200, k=3,
+                         lambda_values=(0.5, 1e-310, 5e-324)):
+    """Checks that the gradients calculated with each of
+    lambda_values are the gradients without regularization plus
+    lambda_param*theta/m, with a cache of arrays, with chunked
+    arrays and for a stack of k networks, and prints the results.
+    The very small values of lambda_param (subnormal numbers)
+    check that the results are finite.  Returns True if they all
+    match.
+    """
+
+    np.random.seed(0)
+    net = MLPNetwork(list(ndim), act_funcs=['tanh', 'sigmoid'],
+                     cost_function='mse')
+    net.initialize_weights()
+    data = MLPTrainingData(inputs=np.random.randn(m, ndim[0]),
+                           outputs=np.random.rand(m, ndim[-1]))
+    stack = MLPNetworkStack(net, k)
+    stack.initialize_weights()
+
+    def full(lambda_param):
+        cache = initialize_arrays(net, m, training_data=data)
+        return net.cost_function(net, data, lambda_param=lambda_param,
+                                 cache=cache)
+
+    def chunked(lambda_param):
+        cache = initialize_chunked_arrays(net, m, chunk_size=m//3)
+        return net.cost_function(net, data, lambda_param=lambda_param,
+                                 cache=cache)
+
+    def stacked(lambda_param):
+        return cost_function_stack(stack, data,
+                                   lambda_param=lambda_param)
+
+    checks = [
+        ('arrays', full, net.weights),
+        ('chunked', chunked, net.weights),
+        ('stack', stacked, stack.weights)
+    ]
+
+    print("%-10s %10s %s" % ("", "lambda", "result"))
+    success = True
+    for name, f, weights in checks:
+        theta = weight_views(net, weights)[0]
+        unregularized = f(0.0)[1].copy()
+        for lambda_param in lambda_values:
+
+            # The regularization terms of the very small values
+            # underflow to zero
+            with np.errstate(under='ignore'):
+                J, grad = f(lambda_param)
+                expected = unregularized.copy()
+                expected_theta = weight_views(net, expected)[0]
+                for j in range(1, net.n_layers):
+                    expected_theta[j] += (lambda_param/m)*theta[j]
+
+            ok = np.all(np.isfinite(J)) and np.all(np.isfinite(grad)) \
+                and np.allclose(grad, expected, rtol=1e-12, atol=0.0)
+            success = success and ok
+            print("%-10s %10.3g %s" % (name, lambda_param,
+                                       "OK" if ok else "FAILED"))
+
+    return success
+
+
 def compute_function_gradient(f, x, e=1.0e-7):
     """Returns a numerical estimate of the gradient of
     function f at point x."""